@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+"""
+Measure the json encode/decode cost per row under each available codec.
+
+No CouchDB server is needed. Synthetic view responses and _bulk_docs payloads are
+encoded and decoded the same way :class:`couchdbreq.resource.CouchdbResource` does.
+
+Usage: python benchmarks/bench_codec.py [rows]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchdbreq.codec import JsonCodec, SimplejsonCodec, UjsonCodec
+from couchdbreq.jsonstream import JsonStreamParser
+
+def make_doc(i):
+    return {
+        '_id': 'doc-%08d' % i,
+        '_rev': '1-967a00dff5e02add41819138abb3284d',
+        'type': 'measurement',
+        'name': u'Sensor n°%d' % i,
+        'value': i * 1.5,
+        'tags': ['alpha', 'beta', 'gamma'],
+        'location': { 'lat': 51.5072, 'lon': -0.1275 },
+        'active': i % 2 == 0,
+    }
+
+def make_view(rows):
+    return {
+        'total_rows': rows,
+        'offset': 0,
+        'rows': [{ 'id': doc['_id'], 'key': doc['_id'], 'value': { 'rev': doc['_rev'] }, 'doc': doc }
+                 for doc in (make_doc(i) for i in range(rows))],
+    }
+
+def available_codecs():
+    codecs = [JsonCodec()]
+    for cls in (SimplejsonCodec, UjsonCodec):
+        try:
+            codecs.append(cls())
+        except ImportError:
+            print '%s not installed, skipping' % cls.name
+    return codecs
+
+def per_row(func, rows, repeat=5):
+    """ Best time per row in microseconds """
+    return min(timeit.repeat(func, number=1, repeat=repeat)) / rows * 1e6
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    view = make_view(rows)
+    bulk = { 'docs': [make_doc(i) for i in range(rows)] }
+
+    codecs = available_codecs()
+
+    print '%d rows, times in microseconds per row' % rows
+    print '%-12s %12s %12s %12s %12s' % ('codec', 'view decode', 'view stream', 'bulk encode', 'bulk decode')
+
+    for codec in codecs:
+        view_body = codec.dumps(view)
+        bulk_body = codec.dumps(bulk)
+        chunks = [view_body[i:i + 16 * 1024] for i in range(0, len(view_body), 16 * 1024)]
+
+        print '%-12s %12.2f %12.2f %12.2f %12.2f' % (
+            codec.name,
+            per_row(lambda: codec.loads(view_body), rows),
+            per_row(lambda: list(JsonStreamParser(chunks, 'rows', codec.loads)), rows),
+            per_row(lambda: codec.dumps(bulk), rows),
+            per_row(lambda: codec.loads(bulk_body), rows),
+        )
+
+if __name__ == '__main__':
+    main()
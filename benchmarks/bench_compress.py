@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+"""
+Measure the effect of gzip request compression on _bulk_docs throughput.
+
+Without arguments the payload of each batch is encoded and compressed locally and the
+time to send it over a link of the given bandwidth is estimated. With --uri the batches
+are saved to a real server with and without compression.
+
+Usage: python benchmarks/bench_compress.py [--batch 1000] [--mbit 100] [--uri http://127.0.0.1:5984]
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchdbreq import Server
+from couchdbreq.body import GzipBody
+from couchdbreq.codec import JsonCodec
+
+from bench_codec import make_doc
+
+def make_realistic_doc(i):
+    """ Add random content so the batch does not compress unrealistically well """
+    doc = make_doc(i)
+    del doc['_rev']
+    doc['_id'] = uuid.uuid4().hex
+    doc['value'] = random.random() * 1000
+    doc['readings'] = [round(random.gauss(20, 5), 3) for _ in range(8)]
+    doc['source'] = uuid.uuid4().hex
+    return doc
+
+def simulate(docs, mbit):
+    payload = JsonCodec().dumps({ 'docs': docs })
+
+    start = time.time()
+    compressed = sum(len(chunk) for chunk in GzipBody(payload))
+    compress_time = time.time() - start
+
+    bytes_per_second = mbit * 1e6 / 8
+    raw_time = len(payload) / bytes_per_second
+    # Compression is streamed so it overlaps with sending
+    gzip_time = max(compress_time, compressed / bytes_per_second)
+
+    print 'payload %.1f MB, compressed %.1f MB (%.1fx), compression %.0f MB/s' % (
+        len(payload) / 1e6, compressed / 1e6, float(len(payload)) / compressed,
+        len(payload) / 1e6 / compress_time)
+    print 'at %d Mbit/s: %8.0f docs/s uncompressed, %8.0f docs/s gzip' % (
+        mbit, len(docs) / raw_time, len(docs) / gzip_time)
+
+def run(uri, docs):
+    for threshold in (None, 1024):
+        server = Server(uri, timeout=300, compress_threshold=threshold)
+        db = server.get_or_create_db('couchdbreq_bench_compress')
+        try:
+            start = time.time()
+            db.save_docs(docs)
+            elapsed = time.time() - start
+        finally:
+            server.delete_db('couchdbreq_bench_compress')
+        for doc in docs:
+            del doc['_rev']
+        print '%-14s %8.0f docs/s' % ('gzip' if threshold else 'uncompressed', len(docs) / elapsed)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--batch', type='int', default=10000)
+    parser.add_option('--mbit', type='float', default=100)
+    parser.add_option('--uri')
+    options, _ = parser.parse_args()
+
+    docs = [make_realistic_doc(i) for i in range(options.batch)]
+
+    if options.uri:
+        run(options.uri, docs)
+    else:
+        simulate(docs, options.mbit)
+
+if __name__ == '__main__':
+    main()
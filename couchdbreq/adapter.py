@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import socket
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+class PoolMetrics(object):
+    """
+    Counters of connection pool usage shared by every pool of an adapter.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.pools = 0
+        self.checkouts = 0
+        self.new_connections = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+        self._lock = threading.Lock()
+
+    def _pool_created(self):
+        with self._lock:
+            self.pools += 1
+
+    def _checked_out(self, wait_time):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def _returned(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def _connected(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self):
+        """
+        :return: dict with the keys
+
+            - pools: Number of connection pools (one per host)
+            - in_use: Connections currently checked out
+            - max_in_use: The most connections checked out at once
+            - utilization: in_use as a fraction of the pool size of all pools
+            - checkouts: Number of times a connection was taken from a pool
+            - new_connections: Number of connections opened
+            - reuse_ratio: Fraction of checkouts which reused an open connection
+            - wait_time: Total seconds spent waiting for a connection
+            - avg_wait_time: Average seconds spent waiting for a connection
+            - max_wait_time: Longest wait for a connection in seconds
+        """
+        with self._lock:
+            capacity = self.maxsize * self.pools
+            return {
+                'pools': self.pools,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'utilization': float(self.in_use) / capacity if capacity else 0.0,
+                'checkouts': self.checkouts,
+                'new_connections': self.new_connections,
+                'reuse_ratio': 1.0 - float(self.new_connections) / self.checkouts if self.checkouts else 0.0,
+                'wait_time': self.wait_time,
+                'avg_wait_time': self.wait_time / self.checkouts if self.checkouts else 0.0,
+                'max_wait_time': self.max_wait_time,
+            }
+
+def _metered_pool_class(base, metrics):
+    """ Create a subclass of a urllib3 connection pool class reporting to metrics """
+
+    class MeteredConnectionPool(base):
+
+        def __init__(self, *args, **kwargs):
+            base.__init__(self, *args, **kwargs)
+            metrics._pool_created()
+
+        def _new_conn(self):
+            metrics._connected()
+            return base._new_conn(self)
+
+        def _get_conn(self, timeout=None):
+            start = time.time()
+            conn = base._get_conn(self, timeout)
+            metrics._checked_out(time.time() - start)
+            return conn
+
+        def _put_conn(self, conn):
+            metrics._returned()
+            return base._put_conn(self, conn)
+
+    return MeteredConnectionPool
+
+class PoolAdapter(HTTPAdapter):
+    """
+    A transport adapter with explicit pool and socket settings which records pool metrics.
+
+    See :class:`couchdbreq.Session` for the parameters.
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ['socket_options']
+
+    def __init__(self, pool_connections, pool_maxsize, pool_block, socket_options, max_retries=0):
+        self.socket_options = socket_options
+        self.metrics = PoolMetrics(pool_maxsize)
+        HTTPAdapter.__init__(self, pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                             max_retries=max_retries, pool_block=pool_block)
+
+    def __setstate__(self, state):
+        self.metrics = PoolMetrics(state['_pool_maxsize'])
+        HTTPAdapter.__setstate__(self, state)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('socket_options', self.socket_options)
+        HTTPAdapter.init_poolmanager(self, connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _metered_pool_class(HTTPConnectionPool, self.metrics),
+            'https': _metered_pool_class(HTTPSConnectionPool, self.metrics),
+        }
+
+def make_socket_options(tcp_nodelay=True, tcp_keepalive=False, socket_options=None):
+    """ Build the list of (level, option, value) tuples set on each new socket """
+    options = []
+    if tcp_nodelay:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    if tcp_keepalive:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if socket_options:
+        options.extend(socket_options)
+    return options
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import itertools
+import threading
+import time
+
+import requests
+
+class Node(object):
+    """
+    One CouchDB node of a cluster and the statistics used to choose between nodes.
+
+    Do not construct directly. Use :class:`couchdbreq.Server` with a list of uris.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.outstanding = 0 # Number of requests in flight
+        self.ewma = None # Moving average of the request latency in seconds
+        self.failures = 0 # Number of consecutive failures
+        self.is_ejected = False
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.uri)
+
+class RoundRobinStrategy(object):
+    """ Send requests to each node in turn """
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, nodes):
+        return nodes[self._counter.next() % len(nodes)]
+
+class LeastOutstandingStrategy(object):
+    """ Send requests to the node with the fewest requests in flight """
+
+    def choose(self, nodes):
+        return min(nodes, key=lambda node: node.outstanding)
+
+class EwmaStrategy(object):
+    """
+    Send requests to the node with the lowest expected latency.
+
+    The expected latency is the moving average latency of the node multiplied by the
+    number of requests in flight plus one. Nodes with no latency samples are preferred
+    so that every node gets measured.
+
+    :param decay: Weight of the newest sample in the moving average
+    """
+
+    def __init__(self, decay=0.3):
+        self.decay = decay
+
+    def choose(self, nodes):
+        return min(nodes, key=lambda node: (node.ewma or 0.0) * (node.outstanding + 1))
+
+class NodeSet(object):
+    """
+    Distributes requests over several nodes and tracks their health.
+
+    A node which fails max_failures times in a row (connection errors, timeouts and 5xx
+    responses) is ejected and no longer receives requests. A background thread probes
+    ejected nodes every probe_interval seconds and returns them to service once they respond.
+    If every node is ejected requests are spread over all of them.
+
+    :param uris: list of node uris
+    :param session: The :class:`couchdbreq.Session` used for probes
+    :param strategy: The strategy choosing a node for each request. Defaults to
+            :class:`couchdbreq.balancer.RoundRobinStrategy`
+    :param max_failures: Number of consecutive failures after which a node is ejected
+    :param probe_interval: Seconds between probes of ejected nodes
+    :param probe_timeout: Timeout in seconds of a probe request
+    """
+
+    def __init__(self, uris, session, strategy=None, max_failures=3, probe_interval=5.0, probe_timeout=2.0):
+        self.nodes = [Node(uri) for uri in uris]
+        self.strategy = strategy or RoundRobinStrategy()
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+
+        self._session = session
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def acquire(self):
+        """ Choose the node for a request. Call release() when the request has finished. """
+        with self._lock:
+            nodes = [node for node in self.nodes if not node.is_ejected] or self.nodes
+            node = self.strategy.choose(nodes)
+            node.outstanding += 1
+            return node
+
+    def release(self, node, latency=None, is_failure=False):
+        """
+        :param node: The node returned by acquire()
+        :param latency: Seconds taken by the request
+        :param is_failure: True if the request failed in a way indicating the node is unhealthy
+        """
+        with self._lock:
+            node.outstanding -= 1
+
+            if latency is not None:
+                decay = getattr(self.strategy, 'decay', 0.3)
+                if node.ewma is None:
+                    node.ewma = latency
+                else:
+                    node.ewma = decay * latency + (1 - decay) * node.ewma
+
+            if not is_failure:
+                node.failures = 0
+                return
+
+            node.failures += 1
+            if node.failures >= self.max_failures and not node.is_ejected:
+                node.is_ejected = True
+                self._start_prober()
+
+    def _start_prober(self):
+        """ Called holding the lock """
+        if self._prober is not None:
+            return
+        self._prober = threading.Thread(target=self._probe_loop, name='couchdbreq-prober')
+        self._prober.daemon = True
+        self._prober.start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+
+            with self._lock:
+                ejected = [node for node in self.nodes if node.is_ejected]
+                if not ejected:
+                    self._prober = None
+                    return
+
+            for node in ejected:
+                if self._probe(node):
+                    with self._lock:
+                        node.is_ejected = False
+                        node.failures = 0
+                        node.ewma = None
+
+    def _probe(self, node):
+        try:
+            resp = self._session.get(node.uri, timeout=self.probe_timeout)
+        except (requests.RequestException, IOError):
+            return False
+        resp.close()
+        return resp.status_code < 500
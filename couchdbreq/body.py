@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import uuid
+import zlib
+
+class EncodedJson(str):
+    """
+    A request body which has already been encoded as json. It is sent with a json
+    Content-Type and may be compressed like a body encoded by the resource.
+    """
+
+class GzipBody(object):
+    """
+    A request body compressed with gzip as it is sent.
+
+    The compressed body is produced a chunk at a time so it is never held in memory
+    alongside the uncompressed data. It can be iterated more than once so a request
+    with a compressed body can be retried.
+
+    :param data: str or an iterable of str chunks which can be iterated more than once
+    :param level: zlib compression level. Level 1 compresses json almost as well as the
+            higher levels at several times the speed.
+    :param chunk_size: Size of the slices of data which are compressed at a time
+    """
+
+    def __init__(self, data, level=1, chunk_size=64 * 1024):
+        self.data = data
+        self.level = level
+        self.chunk_size = chunk_size
+
+    def _chunks(self):
+        data = self.data
+        if isinstance(data, basestring):
+            for i in xrange(0, len(data), self.chunk_size):
+                yield buffer(data, i, self.chunk_size)
+        else:
+            for chunk in data:
+                yield chunk
+
+    def __iter__(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in self._chunks():
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+class JsonArrayBody(object):
+    """
+    A json object with one array member which is encoded as it is sent.
+
+    The items are encoded one at a time and sent in chunks of about chunk_size bytes so
+    the encoded document is never held in memory. The length is not known in advance so
+    the body is sent with chunked transfer encoding. The items are only iterated once.
+
+    :param items: iterable of items to encode into the array
+    :param dumps: Function used to encode json to str
+    :param array_key: The key of the array in the object
+    :param meta: Optional dict of the other members of the object
+    :param chunk_size: Approximate size of the chunks which are sent
+    """
+
+    def __init__(self, items, dumps, array_key, meta=None, chunk_size=64 * 1024):
+        self.items = items
+        self.dumps = dumps
+        self.array_key = array_key
+        self.meta = meta
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        dumps = self.dumps
+        if self.meta:
+            head = dumps(self.meta)[:-1] + ', '
+        else:
+            head = '{'
+
+        buf = [head, dumps(self.array_key), ': [']
+        size = 0
+        separator = ''
+        for item in self.items:
+            encoded = dumps(item)
+            buf.append(separator)
+            buf.append(encoded)
+            separator = ', '
+            size += len(encoded)
+            if size >= self.chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        buf.append(']}')
+        yield ''.join(buf)
+
+def get_length(data):
+    """
+    The number of bytes which will be read from a str or file object.
+
+    :return: int or None if the length of the file object is unknown
+    """
+    if isinstance(data, basestring):
+        return len(data)
+
+    try:
+        size = os.fstat(data.fileno()).st_size
+    except (AttributeError, IOError, OSError):
+        size = None
+    if size is None and hasattr(data, 'getvalue'):
+        size = len(data.getvalue()) # StringIO
+    if size is None:
+        return None
+
+    try:
+        return size - data.tell()
+    except (AttributeError, IOError):
+        return size
+
+class _ReadableBody(object):
+    """
+    A request body with a known length which is read like a file as it is sent.
+    Subclasses implement _iter_chunks.
+    """
+
+    def __init__(self, length):
+        self._length = length
+        self._iter = None
+        self._chunk = '' # The chunk being read
+        self._offset = 0 # The number of bytes of the chunk already read
+
+    def _iter_chunks(self):
+        raise NotImplementedError()
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if self._iter is None:
+            self._iter = self._iter_chunks()
+
+        # Whole chunks are returned without copying and only the bytes needed are sliced
+        # from a partly read chunk, so each byte is copied at most once before the join
+        pieces = []
+        while size != 0:
+            if self._offset == len(self._chunk):
+                try:
+                    self._chunk = self._iter.next()
+                except StopIteration:
+                    break
+                self._offset = 0
+                continue
+
+            end = len(self._chunk) if size < 0 else min(self._offset + size, len(self._chunk))
+            if self._offset == 0 and end == len(self._chunk):
+                pieces.append(self._chunk)
+            else:
+                pieces.append(self._chunk[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+def _iter_file(f, length, chunk_size):
+    remaining = length
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            raise IOError("File is shorter than its length of %d bytes" % length)
+        remaining -= len(chunk)
+        yield chunk
+
+class FileBody(_ReadableBody):
+    """
+    A request body read from a file chunk_size bytes at a time as it is sent.
+
+    :param f: file object
+    :param length: Number of bytes to send from the current position of f
+    :param chunk_size: Size of the reads from f
+    :param callback: Optional function called as callback(bytes_sent, length) after each read
+    """
+
+    def __init__(self, f, length, chunk_size=64 * 1024, callback=None):
+        _ReadableBody.__init__(self, length)
+        self.f = f
+        self.chunk_size = chunk_size
+        self.callback = callback
+
+    def _iter_chunks(self):
+        sent = 0
+        for chunk in _iter_file(self.f, self._length, self.chunk_size):
+            sent += len(chunk)
+            if self.callback is not None:
+                self.callback(sent, self._length)
+            yield chunk
+
+class MultipartRelatedBody(_ReadableBody):
+    """
+    A multipart/related request body which reads each part as it is sent.
+
+    The length is computed up front so the body is sent with a Content-Length. It is
+    read through read() like a file so a part which is a file is streamed from the file
+    chunk_size bytes at a time.
+
+    :param parts: list of (content_type, data) where data is a str or a file object
+            with a known length, see :func:`get_length`.
+    :param chunk_size: Size of the reads from file objects
+    """
+
+    def __init__(self, parts, chunk_size=64 * 1024):
+        _ReadableBody.__init__(self, 0)
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/related; boundary="%s"' % self.boundary
+        self.chunk_size = chunk_size
+
+        self._pieces = []
+        for content_type, data in parts:
+            length = get_length(data)
+            if length is None:
+                raise ValueError("The length of a multipart part must be known")
+            self._add('--%s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                      % (self.boundary, content_type, length))
+            self._pieces.append((data, length))
+            self._length += length
+            self._add('\r\n')
+        self._add('--%s--' % self.boundary)
+
+    def _add(self, s):
+        self._pieces.append((s, len(s)))
+        self._length += len(s)
+
+    def _iter_chunks(self):
+        for data, length in self._pieces:
+            if isinstance(data, basestring):
+                for i in xrange(0, length, self.chunk_size):
+                    yield data[i:i + self.chunk_size]
+            else:
+                for chunk in _iter_file(data, length, self.chunk_size):
+                    yield chunk
+
+def is_replayable(payload):
+    """ Can the payload be sent more than once """
+    if isinstance(payload, GzipBody):
+        return is_replayable(payload.data)
+    return payload is None or isinstance(payload, basestring)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import copy
+import threading
+import time
+
+from collections import OrderedDict
+from Queue import Queue, Empty, Full
+
+from .body import EncodedJson
+from .concurrency import Future
+from .exceptions import ResourceError
+
+class _Pending(object):
+
+    __slots__ = ('doc', 'encoded', 'size', 'future')
+
+    def __init__(self, doc, encoded, size, future):
+        self.doc = doc # The document to save or the id of the document to read
+        self.encoded = encoded
+        self.size = size
+        self.future = future
+
+class _Flush(object):
+    """ Queued to wait for the documents queued before it """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+_CLOSE = object()
+
+class _Batcher(object):
+    """
+    Collects items from many threads and processes them in batches on a background thread.
+
+    A batch is processed once it holds max_items items or max_bytes bytes, or max_delay
+    seconds after its first item was added. When max_queue items are waiting the calling
+    threads block until the background thread catches up.
+    """
+
+    _POLL_INTERVAL = 0.1 # Seconds between checks for close while the queue is full
+
+    def __init__(self, name, max_items, max_bytes, max_delay, max_queue):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self._queue = Queue(max_queue)
+        self._lock = threading.Lock()
+        self._is_closed = False
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while True:
+            if self._is_closed or not self._thread.is_alive():
+                raise self._closed_error()
+            try:
+                self._queue.put(item, timeout=self._POLL_INTERVAL)
+                break
+            except Full:
+                pass
+
+        if self._is_closed:
+            # The item may be behind _CLOSE so fail it once the thread has exited
+            self._thread.join()
+            self._fail_queued()
+
+    def _closed_error(self):
+        return ValueError("The %s is closed" % self.__class__.__name__)
+
+    def flush(self, timeout=None):
+        """
+        Process all items added so far and wait for them
+
+        :param timeout: Maximum seconds to wait or None to wait forever
+        :return: bool, True if all items have been processed
+        :raise: ValueError if closed
+        """
+        flush = _Flush()
+        self._put(flush)
+        return flush.event.wait(timeout)
+
+    def close(self):
+        """ Process all items added so far and stop the background thread """
+        with self._lock:
+            if self._is_closed:
+                return
+            self._is_closed = True
+
+        while self._thread.is_alive():
+            try:
+                self._queue.put(_CLOSE, timeout=self._POLL_INTERVAL)
+                break
+            except Full:
+                pass
+        self._thread.join()
+        self._fail_queued()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, with_type, value, traceback):
+        self.close()
+
+    def _run(self):
+        batch = []
+        size = 0
+        deadline = None
+        while True:
+            try:
+                if deadline is None:
+                    item = self._queue.get()
+                else:
+                    item = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except Empty:
+                item = None # The batch has waited max_delay
+
+            if isinstance(item, _Pending):
+                batch.append(item)
+                size += item.size
+                if deadline is None:
+                    deadline = time.time() + self.max_delay
+                if len(batch) < self.max_items and size < self.max_bytes:
+                    continue
+
+            if batch:
+                try:
+                    self._process(batch)
+                except Exception as e:
+                    for pending in batch:
+                        if not pending.future.done():
+                            pending.future.set_exception(e)
+                batch = []
+                size = 0
+                deadline = None
+
+            if item is _CLOSE:
+                self._fail_queued()
+                return
+            if isinstance(item, _Flush):
+                item.event.set()
+
+    def _fail_queued(self):
+        """ Fail anything queued after _CLOSE so that no caller waits forever """
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                return
+            if isinstance(item, _Pending):
+                item.future.set_exception(self._closed_error())
+            elif isinstance(item, _Flush):
+                item.event.set()
+
+    def _process(self, batch):
+        raise NotImplementedError()
+
+class BulkWriter(_Batcher):
+    """
+    Buffers document writes and saves them with _bulk_docs on a background thread.
+
+    A batch is sent once it holds max_docs documents or max_bytes of encoded documents,
+    or max_delay seconds after its first document was added. Documents are encoded when
+    they are added so the encoding is done by the calling threads. When max_queue documents
+    are waiting to be sent the calling threads block until the background thread catches up.
+
+    Each write returns a :class:`couchdbreq.concurrency.Future` for the new revision. When the
+    write fails the future raises the error, e.g. :class:`couchdbreq.exceptions.ResourceConflict`.
+    The `_id` and `_rev` of the document are updated by the background thread once it is saved.
+
+    Do not construct directly. Use :meth:`couchdbreq.Database.bulk_writer`::
+
+        with db.bulk_writer() as writer:
+            for doc in docs:
+                writer.save(doc)
+
+    :param db: The :class:`couchdbreq.Database` to write to
+    :param max_docs: Maximum number of documents in a batch
+    :param max_bytes: Maximum size in bytes of the encoded documents in a batch
+    :param max_delay: Maximum seconds a document waits before its batch is sent
+    :param max_queue: Maximum number of documents waiting to be sent
+    """
+
+    def __init__(self, db, max_docs=1000, max_bytes=1024 * 1024, max_delay=0.1, max_queue=10000):
+        self.db = db
+        _Batcher.__init__(self, 'couchdbreq-bulk-%s' % db.name, max_docs, max_bytes, max_delay, max_queue)
+
+    def save(self, doc, encode_attachments=True):
+        """
+        Save a document. Blocks if the queue is full.
+
+        :param doc: dict. An `_id` is added if it is not set.
+        :param encode_attachments: If True base64 encode the data of inline attachments
+        :return: :class:`couchdbreq.concurrency.Future` for the new revision
+        """
+        if '_id' not in doc:
+            doc['_id'] = self.db._server.generate_uuid()
+        if '_attachments' in doc and encode_attachments:
+            doc['_attachments'] = self.db._encode_attachments(doc['_attachments'])
+
+        encoded = self.db._res.codec.dumps(doc)
+        future = Future()
+        self._put(_Pending(doc, encoded, len(encoded), future))
+        return future
+
+    def delete(self, doc):
+        """
+        Delete a document. The document will have a _deleted field set to true.
+
+        :param doc: dict with `_id` and `_rev`
+        :return: :class:`couchdbreq.concurrency.Future` for the new revision
+        """
+        if '_id' not in doc or '_rev' not in doc:
+            raise KeyError('_id and _rev are required to delete a doc')
+
+        doc['_deleted'] = True
+        return self.save(doc)
+
+    def _process(self, batch):
+        payload = EncodedJson('{"docs": [%s]}' % ', '.join(pending.encoded for pending in batch))
+        results = self.db._res.post('_bulk_docs', payload=payload).json_body
+
+        for pending, res in zip(batch, results):
+            if 'error' in res:
+                pending.future.set_exception(ResourceError.create_from_bulk_result(res))
+            else:
+                pending.doc['_id'] = res['id']
+                pending.doc['_rev'] = res['rev']
+                pending.future.set_result(res['rev'])
+
+class BulkReader(_Batcher):
+    """
+    Collects document reads from many threads and fetches them with one _all_docs request.
+
+    A batch is fetched once it holds max_docs reads or max_delay seconds after its first
+    read was added. A document read by several threads in one batch is fetched once and
+    each thread gets its own copy.
+
+    Each read returns a :class:`couchdbreq.concurrency.Future` for the document. If the
+    document is missing or deleted the future raises :class:`couchdbreq.exceptions.ResourceNotFound`.
+
+    Do not construct directly. Use :meth:`couchdbreq.Database.bulk_reader`.
+
+    :param db: The :class:`couchdbreq.Database` to read from
+    :param max_docs: Maximum number of documents in a batch
+    :param max_delay: Maximum seconds a read waits before its batch is fetched
+    :param max_queue: Maximum number of reads waiting to be fetched
+    """
+
+    def __init__(self, db, max_docs=100, max_delay=0.002, max_queue=10000):
+        self.db = db
+        _Batcher.__init__(self, 'couchdbreq-bulk-reader-%s' % db.name, max_docs, float('inf'), max_delay, max_queue)
+
+    def get(self, docid):
+        """
+        Read a document. Blocks if the queue is full.
+
+        :param docid: str, document id to retrieve
+        :return: :class:`couchdbreq.concurrency.Future` for the document
+        """
+        future = Future()
+        self._put(_Pending(docid, None, 0, future))
+        return future
+
+    def _process(self, batch):
+        futures = OrderedDict() # docid -> futures reading it
+        for pending in batch:
+            futures.setdefault(pending.doc, []).append(pending.future)
+
+        docs = self.db.get_docs(futures.keys(), chunk_size=len(futures), parallel=1)
+        for (docid, waiting), doc in zip(futures.iteritems(), docs):
+            if doc is None:
+                reason = 'deleted' if docid in docs.deleted else 'missing'
+                error = ResourceError.create_from_bulk_result({ 'error': 'not_found', 'reason': reason })
+                for future in waiting:
+                    future.set_exception(error)
+                continue
+
+            # Copy before any reader gets the document because readers may modify it
+            copies = [doc] + [copy.deepcopy(doc) for _ in waiting[1:]]
+            for future, doc in zip(waiting, copies):
+                future.set_result(doc)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class DocumentCache(object):
+    """
+    A bounded LRU cache of raw document bodies and their ETags for :meth:`couchdbreq.Database.get_doc`.
+
+    Use with :meth:`couchdbreq.Database.set_doc_cache`. A cached document is revalidated with
+    If-None-Match on every read so reads are never stale. When the document has not changed
+    CouchDB replies 304 Not Modified without a body and the cached body is used. Reads of a
+    specific revision are served from the cache without a request because revisions never change.
+
+    Bodies are cached undecoded so every read returns a new dict which may be modified.
+
+    :param max_entries: Maximum number of documents to cache
+    :param max_bytes: Maximum total size of the cached bodies
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits = 0 # Reads served from the cache, including after a 304
+        self.misses = 0 # Reads which downloaded the document
+        self.revalidations = 0 # Reads which sent If-None-Match
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (etag, body)
+        self._bytes = 0
+
+    def get(self, key):
+        """
+        :return: tuple of (etag, body) or None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry # Most recently used is last
+            return entry
+
+    def put(self, key, etag, body):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+
+            if len(body) > self.max_bytes:
+                return
+
+            self._entries[key] = (etag, body)
+            self._bytes += len(body)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def record(self, hits=0, misses=0, revalidations=0):
+        """ Add to the counters returned by get_stats. Called by the users of the cache. """
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.revalidations += revalidations
+
+    def get_stats(self):
+        """
+        :return: dict with entries, bytes, hits, misses and revalidations
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+def _seq_number(seq):
+    """ The numeric part of an update sequence. CouchDB 2+ sequences look like '123-g1AAAA...' """
+    if isinstance(seq, (int, long)):
+        return seq
+    return int(str(seq).split('-', 1)[0])
+
+class ChangesCache(object):
+    """
+    Serves documents from memory and keeps them fresh by following the changes feed.
+
+    A background thread long polls the _changes feed of the database and evicts every
+    document which changes, so a cached document is at most one poll behind CouchDB. If
+    the feed fails the whole cache is cleared because changes may have been missed.
+    A document fetched while changes arrive is not cached, so a stale copy is never kept.
+
+    Use :meth:`wait_for_seq` to read your own writes::
+
+        cache = ChangesCache(db)
+        db.save_doc(doc)
+        cache.wait_for_seq(db.get_info()['update_seq'])
+        doc = cache.get_doc(doc['_id'])
+
+    :param db: The :class:`couchdbreq.Database` to cache
+    :param max_entries: Maximum number of documents to cache
+    :param max_bytes: Maximum total size of the cached documents
+    :param poll_timeout: Seconds each long poll waits for changes. Must be shorter than the
+            timeout of the server.
+    :param retry_interval: Seconds to wait before polling again after an error
+    """
+
+    def __init__(self, db, max_entries=10000, max_bytes=64 * 1024 * 1024, poll_timeout=1.0, retry_interval=1.0):
+        self.db = db
+        self.poll_timeout = poll_timeout
+        self.retry_interval = retry_interval
+
+        self._docs = DocumentCache(max_entries, max_bytes)
+        self._condition = threading.Condition()
+        self._generation = 0 # Incremented whenever documents are evicted
+        self._last_seq = db.get_info()['update_seq']
+        self._is_closed = False
+
+        self._thread = threading.Thread(target=self._follow, name='couchdbreq-changes-%s' % db.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def last_seq(self):
+        """ The update sequence of the last change applied to the cache """
+        with self._condition:
+            return self._last_seq
+
+    def get_doc(self, docid, schema=None):
+        """
+        Get a document from the cache or from the database if it is not cached
+
+        :param docid: str, document id to retrieve
+        :param schema: A schema with a function wrap_doc(doc) used to map the response
+        :return: dict
+        :raise: :class:`couchdbreq.exceptions.ResourceNotFound` if the document does not exist
+        """
+        if not self.is_following():
+            # Cached documents may be stale once changes are no longer applied
+            entry = None
+        else:
+            entry = self._docs.get(docid)
+
+        if entry is not None:
+            self._docs.record(hits=1)
+            body = entry[1]
+        else:
+            with self._condition:
+                generation = self._generation
+
+            body = self.db.get_doc(docid, raw=True)
+            self._docs.record(misses=1)
+
+            with self._condition:
+                if generation == self._generation and self.is_following():
+                    self._docs.put(docid, None, body)
+
+        doc = self.db._res.codec.loads(body)
+        if schema is not None:
+            return schema.wrap_doc(doc)
+        return doc
+
+    def is_following(self):
+        """ :return: bool, True if changes are being applied to the cache """
+        return not self._is_closed and self._thread.is_alive()
+
+    def wait_for_seq(self, seq, timeout=None):
+        """
+        Wait until the changes up to seq have been applied to the cache
+
+        :param seq: An update sequence e.g. from :meth:`couchdbreq.Database.get_info`
+        :param timeout: Maximum seconds to wait or None to wait forever
+        :return: bool, True if the cache has reached seq
+        """
+        target = _seq_number(seq)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while _seq_number(self._last_seq) < target:
+                if not self.is_following():
+                    return False
+                if deadline is None:
+                    self._condition.wait(1.0)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            return True
+
+    def get_stats(self):
+        """ :return: dict, see :meth:`couchdbreq.cache.DocumentCache.get_stats` """
+        return self._docs.get_stats()
+
+    def close(self):
+        """ Stop following the changes feed. The thread exits after the current poll. """
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify_all()
+
+    def _follow(self):
+        while True:
+            with self._condition:
+                if self._is_closed:
+                    return
+                since = self._last_seq
+
+            try:
+                rows = list(self.db.changes(since=since, feed='longpoll',
+                    timeout=int(self.poll_timeout * 1000)))
+                self._apply(rows)
+            except Exception:
+                # Changes may have been missed so nothing cached can be trusted
+                self._apply_failure()
+                time.sleep(self.retry_interval)
+
+    def _apply(self, rows):
+        with self._condition:
+            if rows:
+                self._generation += 1
+                for row in rows:
+                    self._docs.invalidate(row['id'])
+                self._last_seq = rows[-1]['seq']
+            self._condition.notify_all()
+
+    def _apply_failure(self):
+        with self._condition:
+            self._generation += 1
+            self._docs.clear()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import json
+
+class JsonCodec(object):
+    """
+    Encodes request bodies and query parameters and decodes responses.
+
+    The default codec uses the json module from the standard library. Pass another
+    codec to :class:`couchdbreq.Server` to use a faster implementation e.g.::
+
+        server = Server(codec=UjsonCodec())
+
+    To write a codec for another library subclass this class and implement dumps and loads.
+    """
+
+    name = 'json'
+
+    def dumps(self, obj):
+        """
+        :param obj: The object to encode
+        :return: str, utf-8 encoded json
+        """
+        return json.dumps(obj)
+
+    def loads(self, s):
+        """
+        :param s: str, utf-8 encoded json
+        :return: The decoded object
+        """
+        return json.loads(s)
+
+class SimplejsonCodec(JsonCodec):
+    """
+    Codec using simplejson and its C speedups.
+
+    :raise: ImportError if simplejson is not installed
+    """
+
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self._json = simplejson
+
+    def dumps(self, obj):
+        return self._json.dumps(obj)
+
+    def loads(self, s):
+        return self._json.loads(s)
+
+class UjsonCodec(JsonCodec):
+    """
+    Codec using ujson.
+
+    ujson is the fastest codec but does not support arbitrary precision numbers.
+
+    :raise: ImportError if ujson is not installed
+    """
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._json = ujson
+
+    def dumps(self, obj):
+        return self._json.dumps(obj)
+
+    def loads(self, s):
+        return self._json.loads(s)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import threading
+
+from Queue import Queue, Empty
+
+class Future(object):
+    """
+    The result of an operation completed on another thread.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def exception(self):
+        """ Wait for the operation and return its exception or None if it succeeded """
+        self._event.wait()
+        return self._exception
+
+    def result(self):
+        """
+        Wait for the operation and return its result
+
+        :raise: The exception of the operation if it failed
+        """
+        self._event.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+def map_concurrent(func, items, max_workers, callback=None):
+    """
+    Call func(item) for each item on up to max_workers threads.
+
+    An exception raised by func does not stop the other calls. It is returned in place
+    of the result for that item.
+
+    :param func: Function taking one item
+    :param items: iterable of items
+    :param max_workers: Maximum number of threads
+    :param callback: Optional function called as callback(index, item, result, error) after each
+            call completes. error is None if the call succeeded. Calls to callback are serialized.
+    :return: list of results or exceptions in the order of items
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    callback_lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+
+            error = None
+            try:
+                result = func(item)
+            except Exception as e:
+                result = error = e
+            results[i] = result
+
+            if callback is not None:
+                with callback_lock:
+                    callback(i, item, None if error else result, error)
+
+    workers = min(max_workers, len(items))
+    if workers <= 1:
+        work()
+        return results
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
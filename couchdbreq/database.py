@@ -3,17 +3,41 @@
 # This file is part of couchdbkit released under the MIT license.
 # See the NOTICE for more information.
 
+import os
 import re
 import urllib
 import base64
+import hashlib
+import time
 
+from collections import deque, OrderedDict
 from mimetypes import guess_type
 
 from .exceptions import InvalidAttachment, ResourceNotFound, BulkSaveError, DatabaseExistsException
-from .exceptions import InvalidDatabaseNameError, ResourceError, InvalidDocNameError
+from .exceptions import InvalidDatabaseNameError, ResourceError, InvalidDocNameError, ResourceConflict
+from .exceptions import RequestError, AttachmentDigestMismatch
 
 from .utils import url_quote
 from .view import View
+from .body import JsonArrayBody, MultipartRelatedBody, FileBody, get_length
+from .jsonstream import JsonStreamParser
+from .concurrency import map_concurrent
+from .resource import ResponseStream
+from .retry import RetryPolicy
+from .bulk import BulkWriter, BulkReader
+
+class DocumentList(list):
+    """
+    The documents returned by :meth:`couchdbreq.Database.get_docs`.
+
+    The list holds None in place of each document which is missing or deleted.
+    The ids of those documents are in `missing` and `deleted`.
+    """
+
+    def __init__(self):
+        list.__init__(self)
+        self.missing = []
+        self.deleted = []
 
 class Database(object):
     """
@@ -73,6 +97,9 @@ class Database(object):
         
         self._server = server
         self._res = server._res(name, ":") # / is not safe for the dbname
+        self._doc_cache = None
+        self._write_coalescer = None
+        self._read_coalescer = None
 
         if not is_verify_existance:
             return
@@ -156,6 +183,8 @@ class Database(object):
 
         :param docid: str, document id
         :return: boolean, True if document exist
+
+        .. seealso:: :meth:`contains_many` to test many documents
         """
 
         if not docid:
@@ -166,7 +195,7 @@ class Database(object):
             return False
         return True
 
-    def get_doc(self, docid, rev=None, schema=None):
+    def get_doc(self, docid, rev=None, schema=None, raw=False):
         """
         Get document from database
 
@@ -174,8 +203,9 @@ class Database(object):
         :param rev: Get a specific revision of a document
         :param schema: A schema to pass. This is an object with a function wrap_doc(doc)
         which will be used to map the response.
+        :param raw: If True return the undecoded json response. schema is ignored.
         
-        :return: dict, representation of CouchDB document as a dict.
+        :return: dict, representation of CouchDB document as a dict. str if raw=True.
         :raise: :class:`couchdbreq.exceptions.InvalidDocNameError` if the docid is invalid
         """
 
@@ -186,25 +216,199 @@ class Database(object):
         if not docid:
             raise InvalidDocNameError()
 
+        # _all_docs which the coalescer reads through does not return local docs
+        if self._read_coalescer is not None and not rev and not raw and not docid.startswith('_local/'):
+            doc = self._read_coalescer.get(docid).result()
+            if schema is not None:
+                return schema.wrap_doc(doc)
+            return doc
+
         docid = Database._escape_docid(docid)
-        doc = self._res.get(docid, params=params).json_body
+        if self._doc_cache is not None:
+            body = self._get_cached_doc_body(docid, rev, params)
+            if raw:
+                return body
+            doc = self._res.codec.loads(body)
+        else:
+            resp = self._res.get(docid, params=params)
+            if raw:
+                return resp.body_string()
+            doc = resp.json_body
+
         if schema is not None:
             return schema.wrap_doc(doc)
         return doc
 
+    def _get_cached_doc_body(self, docid, rev, params):
+        cache = self._doc_cache
+        key = (docid, rev)
+        entry = cache.get(key)
+
+        if entry is not None and rev:
+            cache.record(hits=1)
+            return entry[1]
+
+        headers = None
+        if entry is not None:
+            headers = { 'If-None-Match': entry[0] }
+
+        resp = self._res.get(docid, params=params, headers=headers)
+        if resp.status_int == 304:
+            cache.record(hits=1, revalidations=1)
+            return entry[1]
+
+        body = resp.body_string()
+        etag = resp.headers.get('etag')
+        if etag:
+            cache.put(key, etag, body)
+        cache.record(misses=1, revalidations=1 if entry is not None else 0)
+        return body
+
+    def set_doc_cache(self, cache):
+        """
+        Cache documents read by get_doc. e.g.::
+
+            db.set_doc_cache(DocumentCache(max_entries=1000, max_bytes=64 * 1024 * 1024))
+
+        :param cache: :class:`couchdbreq.cache.DocumentCache` or None to stop caching
+        """
+        self._doc_cache = cache
+
+    def get_doc_cache(self):
+        """
+        :return: The :class:`couchdbreq.cache.DocumentCache` set with set_doc_cache or None
+        """
+        return self._doc_cache
+
+    def set_write_coalescer(self, writer):
+        """
+        Send concurrent calls to save_doc together in one _bulk_docs request. e.g.::
+
+            db.set_write_coalescer(db.bulk_writer(max_docs=100, max_delay=0.002))
+
+        Each call to save_doc still waits for its own document to be saved, returns its own
+        result and raises its own :class:`couchdbreq.exceptions.ResourceConflict`. Each save
+        waits up to max_delay for other saves to join its batch, so this only helps when
+        many threads are saving at once. Saves with batch=True are not coalesced.
+
+        :param writer: :class:`couchdbreq.bulk.BulkWriter` or None to stop coalescing
+        """
+        self._write_coalescer = writer
+
+    def get_write_coalescer(self):
+        """
+        :return: The :class:`couchdbreq.bulk.BulkWriter` set with set_write_coalescer or None
+        """
+        return self._write_coalescer
+
+    def set_read_coalescer(self, reader):
+        """
+        Fetch documents read by concurrent calls to get_doc together in one _all_docs request. e.g.::
+
+            db.set_read_coalescer(db.bulk_reader(max_docs=100, max_delay=0.002))
+
+        Each call to get_doc still returns its own document and raises
+        :class:`couchdbreq.exceptions.ResourceNotFound` if the document is missing or deleted.
+        Reads of a specific revision, raw reads and reads of `_local/` documents are not coalesced.
+
+        :param reader: :class:`couchdbreq.bulk.BulkReader` or None to stop coalescing
+        """
+        self._read_coalescer = reader
+
+    def get_read_coalescer(self):
+        """
+        :return: The :class:`couchdbreq.bulk.BulkReader` set with set_read_coalescer or None
+        """
+        return self._read_coalescer
+
+    def get_docs(self, ids, schema=None, chunk_size=1000, parallel=None):
+        """
+        Get many documents using _all_docs. e.g.::
+
+            docs = db.get_docs(['id1', 'id2', 'id3'])
+            for docid in docs.missing:
+                ...
+
+        The ids are split into chunks of chunk_size which are fetched concurrently.
+
+        :param ids: iterable of document ids
+        :param schema: A schema with a function wrap_doc(doc) used to map the documents
+        :param chunk_size: Maximum number of ids fetched in one request
+        :param parallel: Maximum number of concurrent requests. Defaults to and is limited by the
+                connection pool size of the session.
+        :return: :class:`couchdbreq.database.DocumentList` of documents in the order of ids
+        """
+        docs = DocumentList()
+        for row in self._get_all_docs_rows(ids, True, chunk_size, parallel):
+            doc = row.get('doc')
+            if 'error' in row:
+                docs.missing.append(row['key'])
+            elif doc is None:
+                docs.deleted.append(row['key'])
+            elif schema is not None:
+                doc = schema.wrap_doc(doc)
+            docs.append(doc)
+        return docs
+
+    def contains_many(self, ids, chunk_size=1000, parallel=None):
+        """
+        Test which documents exist using _all_docs. Deleted documents do not exist.
+
+        :param ids: iterable of document ids
+        :param chunk_size: Maximum number of ids looked up in one request
+        :param parallel: Maximum number of concurrent requests. Defaults to and is limited by the
+                connection pool size of the session.
+        :return: set of the ids which exist
+        """
+        return set(self.get_revs(ids, chunk_size, parallel))
+
+    def get_revs(self, ids, chunk_size=1000, parallel=None):
+        """
+        Get the last revision of many documents using _all_docs.
+
+        :param ids: iterable of document ids
+        :param chunk_size: Maximum number of ids looked up in one request
+        :param parallel: Maximum number of concurrent requests. Defaults to and is limited by the
+                connection pool size of the session.
+        :return: dict of id to revision. Missing and deleted documents are not included.
+        """
+        revs = {}
+        for row in self._get_all_docs_rows(ids, False, chunk_size, parallel):
+            if 'error' in row or row['value'].get('deleted'):
+                continue
+            revs[row['key']] = row['value']['rev']
+        return revs
+
+    def _get_all_docs_rows(self, ids, include_docs, chunk_size, parallel):
+        """ Look up ids in _all_docs in concurrent chunks. Returns the rows in the order of ids. """
+        ids = list(ids)
+        chunks = [ids[i:i + chunk_size] for i in xrange(0, len(ids), chunk_size)]
+
+        def fetch(keys):
+            return self.all_docs(keys=keys, include_docs=include_docs).all()
+
+        rows = []
+        for chunk_rows in map_concurrent(fetch, chunks, self._get_max_workers(parallel)):
+            if isinstance(chunk_rows, Exception):
+                raise chunk_rows
+            rows.extend(chunk_rows)
+        return rows
+
     def get_rev(self, docid):
         """
         Get last revision from docid (the '_rev' member)
 
         :param docid: str, undecoded document id.
         :return rev: str, the last revision of document.
+
+        .. seealso:: :meth:`get_revs` to get the revisions of many documents
         """
         if not docid:
             raise InvalidDocNameError()
         response = self._res.head(Database._escape_docid(docid))
         return response.headers['etag'].strip('"')
 
-    def save_doc(self, doc=None, encode_attachments=True, batch=False):
+    def save_doc(self, doc=None, encode_attachments=True, batch=False, multipart=False):
         """
         Save a document. It will use the `_id` member of the document
         or request a new uuid from CouchDB. IDs are attached to
@@ -215,15 +419,23 @@ class Database(object):
         :param doc: dict. doc is updated with doc '_id' and '_rev' properties returned by CouchDB server when you save.
         :param batch: If true then use reduced guarantee that the document has been saved. The _rev field
                 will not be updated.
+        :param multipart: If true send the data of inline attachments unencoded in a multipart/related
+                request instead of base64 encoding it. The data may be a str or a file object which is
+                streamed. The attachments of doc are replaced by stubs once saved.
         :return: doc updated with '_id' and '_rev'
         :raise: :class:`couchdbreq.exceptions.ResourceConflict` if the save generated a conflict
+
+        .. seealso:: :meth:`set_write_coalescer` to save concurrent calls in one request
         """
         if doc is None:
             doc1 = {}
         else:
             doc1 = doc
 
-        if '_attachments' in doc1 and encode_attachments:
+        body = None
+        if '_attachments' in doc1 and multipart:
+            body, stubs = self._encode_multipart(doc1)
+        elif '_attachments' in doc1 and encode_attachments:
             doc1['_attachments'] = Database._encode_attachments(doc['_attachments'])
             
         params = None
@@ -237,8 +449,17 @@ class Database(object):
         else:
             docid = self._server.generate_uuid()
             
-        docid1 = Database._escape_docid(docid)
-        res = self._res.put(docid1, payload=doc1, params=params).json_body
+        writer = self._write_coalescer
+        if body is not None:
+            res = self._res.put(Database._escape_docid(docid), payload=body, params=params,
+                                headers={ 'Content-Type': body.content_type }).json_body
+            doc1['_attachments'].update(stubs)
+        elif writer is not None and not batch:
+            doc1['_id'] = docid
+            rev = writer.save(doc1, encode_attachments=False).result()
+            res = { 'ok': True, 'id': docid, 'rev': rev }
+        else:
+            res = self._put_doc(docid, doc1, params)
 
         if batch:
             doc1.update({ '_id': res['id']})
@@ -248,43 +469,168 @@ class Database(object):
         doc.update(doc1)
         return res
 
-    def save_docs(self, docs, use_uuids=True, all_or_nothing=False):
+    def _encode_multipart(self, doc):
+        """ :return: tuple of (MultipartRelatedBody, dict of attachment stubs) """
+        json_doc = dict(doc)
+        json_doc['_attachments'] = OrderedDict() # The parts are sent in the order of the attachments
+        parts = [None]
+        stubs = {} # Replace the attachments once saved
+        for name, attachment in doc['_attachments'].iteritems():
+            if attachment.get('stub', False):
+                json_doc['_attachments'][name] = attachment
+                continue
+
+            data = attachment['data']
+            if not (isinstance(data, str) or hasattr(data, 'read')):
+                raise InvalidAttachment("Attachment must be a str, bytes or a stream.")
+            length = get_length(data)
+            if length is None:
+                raise InvalidAttachment("The length of the attachment stream must be known.")
+
+            content_type = attachment.get('content_type') or \
+                ';'.join(filter(None, guess_type(name))) or 'application/octet-stream'
+            json_doc['_attachments'][name] = {
+                'content_type': content_type,
+                'length': length,
+                'follows': True,
+            }
+            stubs[name] = {
+                'content_type': content_type,
+                'length': length,
+                'stub': True,
+            }
+            parts.append((content_type, data))
+
+        parts[0] = ('application/json', self._res.codec.dumps(json_doc))
+        return MultipartRelatedBody(parts), stubs
+
+    def _put_doc(self, docid, doc, params):
+        try:
+            # The _id is fixed so a retried PUT cannot create a duplicate document
+            return self._res.put(Database._escape_docid(docid), payload=doc, params=params,
+                                 idempotent=True).json_body
+        except ResourceConflict as e:
+            if e.attempts == 1:
+                raise
+            return self._get_retried_save_result(docid, doc, e)
+
+    def _get_retried_save_result(self, docid, doc, conflict):
+        """
+        A PUT which was retried got a conflict. This happens when an earlier attempt was
+        saved but the response was lost. The save succeeded if the current revision is the one
+        following the revision we sent and holds the same content.
+        """
+        try:
+            current = self.get_doc(docid)
+        except ResourceNotFound:
+            raise conflict
+
+        rev = current.pop('_rev')
+        sent_rev = doc.get('_rev')
+        sent_generation = int(sent_rev.split('-', 1)[0]) if sent_rev else 0
+        if int(rev.split('-', 1)[0]) != sent_generation + 1:
+            raise conflict
+
+        codec = self._res.codec
+        sent = codec.loads(codec.dumps(doc))
+        sent.pop('_rev', None)
+        sent['_id'] = docid
+        # The server replaces inline attachments with stubs so they are compared separately
+        sent_attachments = sent.pop('_attachments', {})
+        current_attachments = current.pop('_attachments', {})
+        if sent != current or not Database._attachments_match(sent_attachments, current_attachments):
+            raise conflict
+
+        return { 'ok': True, 'id': docid, 'rev': rev }
+
+    @staticmethod
+    def _attachments_match(sent, current):
+        """ True if the stubs in current could be the result of saving the attachments in sent """
+        if set(sent) != set(current):
+            return False
+
+        for name, attachment in sent.iteritems():
+            stub = current[name]
+            if 'data' in attachment:
+                length = len(base64.b64decode(attachment['data']))
+            else:
+                length = attachment.get('length', stub.get('length'))
+            if length != stub.get('length'):
+                return False
+            if attachment.get('content_type', stub.get('content_type')) != stub.get('content_type'):
+                return False
+        return True
+
+    def save_docs(self, docs, use_uuids=True, all_or_nothing=False, stream_chunk_size=64 * 1024,
+                  update_docs=True):
         """
         Save multiple docs at once
 
-        :param docs: list of docs
-        :param use_uuids: add _id in doc who don't have it already set.
+        The request body is encoded as it is sent and the results are parsed as they are
+        received, so the encoded request and response are never held in memory. docs may
+        be a generator which creates the docs as they are sent.
+
+        :param docs: iterable of docs
+        :param use_uuids: add _id in doc who don't have it already set. The uuids are fetched
+        before the request is started so docs must be a list or tuple. The server assigns
+        the _id of docs from any other iterable because no other request can be made while
+        the docs are being sent.
         :param all_or_nothing: In the case of a power failure, when the database
         restarts either all the changes will have been saved or none of them.
         However, it does not do conflict checking.
+        :param stream_chunk_size: Size in bytes of the chunks sent and read
+        :param update_docs: If True set the _id and _rev of each saved doc. If False the docs
+        are not kept once they are sent so a generator of docs uses bounded memory.
+        :return: list of results
 
         .. seealso:: `HTTP Bulk Document API <http://wiki.apache.org/couchdb/HTTP_Bulk_Document_API>`
         """
 
-        if use_uuids:
+        if use_uuids and isinstance(docs, (list, tuple)):
+            docs = list(self._iter_with_uuids(docs)) # Fetch any uuids before the request is started
+
+        # Docs which have been sent waiting for their result
+        sent = deque()
+        def iter_sent(docs):
             for doc in docs:
-                if '_id' not in doc:
-                    doc['_id'] = self._server.generate_uuid()
+                sent.append(doc)
+                yield doc
 
-        payload = { "docs": docs }
+        meta = None
         if all_or_nothing:
-            payload["all_or_nothing"] = True
+            meta = { "all_or_nothing": True }
+        if update_docs:
+            docs = iter_sent(docs)
+        body = JsonArrayBody(docs, self._res.codec.dumps, "docs", meta, stream_chunk_size)
 
-        results = self._res.post('_bulk_docs', payload=payload).json_body
+        resp = self._res.post('_bulk_docs', payload=body, stream=True)
+        try:
+            results = []
+            errors = []
+            for res in JsonStreamParser(resp.body_stream(stream_chunk_size), None, resp.codec.loads):
+                results.append(res)
+                if update_docs:
+                    doc = sent.popleft()
+                if 'error' in res:
+                    errors.append(res)
+                elif update_docs:
+                    doc.update({
+                        '_id': res['id'],
+                        '_rev': res['rev']
+                    })
+        finally:
+            resp.close()
 
-        errors = []
-        for i, res in enumerate(results):
-            if 'error' in res:
-                errors.append(res)
-            else:
-                docs[i].update({
-                    '_id': res['id'],
-                    '_rev': res['rev']
-                })
         if errors:
             raise BulkSaveError(errors, results)
         return results
 
+    def _iter_with_uuids(self, docs):
+        for doc in docs:
+            if '_id' not in doc:
+                doc['_id'] = self._server.generate_uuid()
+            yield doc
+
     def delete_docs(self, docs, all_or_nothing=False):
         """
         Delete many docs at once.
@@ -297,8 +643,15 @@ class Database(object):
 
         .. seealso:: `HTTP Bulk Document API <http://wiki.apache.org/couchdb/HTTP_Bulk_Document_API>`
         """
-        for doc in docs:
-            doc['_deleted'] = True
+        def iter_deleted(docs):
+            for doc in docs:
+                doc['_deleted'] = True
+                yield doc
+
+        if isinstance(docs, (list, tuple)):
+            docs = list(iter_deleted(docs))
+        else:
+            docs = iter_deleted(docs)
 
         return self.save_docs(docs, use_uuids=False, all_or_nothing=all_or_nothing)
 
@@ -363,6 +716,70 @@ class Database(object):
 
         return { 'ok': False }
 
+    def map_concurrent(self, op, items, max_workers=None, callback=None):
+        """
+        Run many independent operations concurrently on a pool of threads. e.g.::
+
+            docs = db.map_concurrent('get_doc', ['id1', 'id2', 'id3'])
+            db.map_concurrent('put_attachment', [(doc1, data1, 'a.txt'), (doc2, data2, 'b.txt')])
+
+        A failed operation does not stop the others. Its exception is returned in place of
+        its result.
+
+        :param op: The name of a method of this database or a function
+        :param items: iterable of arguments. A tuple is passed as positional arguments and any
+                other item as the only argument.
+        :param max_workers: Maximum number of threads. Defaults to and is limited by the
+                connection pool size of the session so threads do not wait for connections.
+        :param callback: Optional function called as callback(index, item, result, error) as each
+                operation completes, e.g. to report progress. error is None on success.
+        :return: list of results or exceptions in the order of items
+        """
+        if isinstance(op, basestring):
+            op = getattr(self, op)
+
+        def call(item):
+            if isinstance(item, tuple):
+                return op(*item)
+            return op(item)
+
+        return map_concurrent(call, items, self._get_max_workers(max_workers), callback)
+
+    def bulk_writer(self, max_docs=1000, max_bytes=1024 * 1024, max_delay=0.1, max_queue=10000):
+        """
+        Create a writer which saves documents in batches on a background thread. e.g.::
+
+            with db.bulk_writer() as writer:
+                futures = [writer.save(doc) for doc in docs]
+            revs = [future.result() for future in futures]
+
+        :param max_docs: Maximum number of documents in a batch
+        :param max_bytes: Maximum size in bytes of the encoded documents in a batch
+        :param max_delay: Maximum seconds a document waits before its batch is sent
+        :param max_queue: Maximum number of documents waiting to be sent. Writes block
+                when the queue is full.
+        :return: :class:`couchdbreq.bulk.BulkWriter`
+        """
+        return BulkWriter(self, max_docs, max_bytes, max_delay, max_queue)
+
+    def bulk_reader(self, max_docs=100, max_delay=0.002, max_queue=10000):
+        """
+        Create a reader which fetches documents read by many threads in batches. See
+        :meth:`set_read_coalescer`.
+
+        :param max_docs: Maximum number of documents in a batch
+        :param max_delay: Maximum seconds a read waits before its batch is fetched
+        :param max_queue: Maximum number of reads waiting to be fetched
+        :return: :class:`couchdbreq.bulk.BulkReader`
+        """
+        return BulkReader(self, max_docs, max_delay, max_queue)
+
+    def _get_max_workers(self, max_workers):
+        pool_maxsize = getattr(self._res.session, 'pool_maxsize', 10)
+        if max_workers is None:
+            return pool_maxsize
+        return min(max_workers, pool_maxsize)
+
     def view(self, view_name, schema=None,
              startkey=View.UNDEFINED_VALUE, endkey=View.UNDEFINED_VALUE,
              keys=None, key=View.UNDEFINED_VALUE,
@@ -463,7 +880,8 @@ class Database(object):
         }
         return View(self, '_all_docs', schema=schema, params=params)
 
-    def put_attachment(self, doc, content, name=None, content_type=None, content_length=None):
+    def put_attachment(self, doc, content, name=None, content_type=None, content_length=None,
+                       refresh=True):
         """
         Add attachment to a document
 
@@ -474,9 +892,15 @@ class Database(object):
         :param content: str or file like object.
         :param name: name of attachment (unicode or str) encoded as utf8
         :param content_type: string, mimetype of attachment. If you don't set it, it will be autodetected.
-        :param content_lenght: int, size of attachment in bytes
+        :param content_lenght: int, size of attachment in bytes. Found from the file if content
+                is a file object.
+        :param refresh: If True get the saved document to update doc. If False update the `_rev`
+                and the attachment stub of doc from the data sent, which saves a request. The
+                stub then has no `digest`, `encoding` or `encoded_length`.
 
         :return: bool, True if everything was ok.
+
+        .. seealso:: :meth:`put_attachment_file` for large files
         """
 
         if not (isinstance(content, bytes) or
@@ -494,6 +918,8 @@ class Database(object):
             'Content-Type': content_type,
         }
 
+        if content_length is None and hasattr(content, 'read'):
+            content_length = get_length(content)
         if content_length != None:
             headers['Content-Length'] = str(content_length)
 
@@ -501,17 +927,81 @@ class Database(object):
         res = self._res(docid).put(name,
                 headers=headers, params={ 'rev': doc['_rev'] }, payload=content).json_body
 
-        if res['ok']:
+        if res['ok'] and refresh:
             new_doc = self.get_doc(doc['_id'], rev=res['rev'])
             doc.update(new_doc)
+        elif res['ok']:
+            doc['_rev'] = res['rev']
+            doc.setdefault('_attachments', {})[name] = Database._get_attachment_stub(
+                content, content_type, content_length, res['rev'])
         return res['ok']
 
-    def delete_attachment(self, doc, name):
+    @staticmethod
+    def _get_attachment_stub(content, content_type, content_length, rev):
+        """
+        The stub CouchDB would return for an attachment which has just been saved.
+
+        It has no `digest` because CouchDB may compress the data before finding the digest.
+        """
+        stub = {
+            'content_type': content_type,
+            'revpos': int(rev.split('-', 1)[0]),
+            'stub': True,
+        }
+
+        if isinstance(content, str):
+            content_length = len(content)
+        if content_length is not None:
+            stub['length'] = content_length
+        return stub
+
+    def put_attachment_file(self, doc, f, name=None, content_type=None,
+                            chunk_size=64 * 1024, callback=None, refresh=True):
+        """
+        Upload a file as an attachment of a document.
+
+        The file is read and sent chunk_size bytes at a time so memory use does not
+        depend on the size of the file. e.g.::
+
+            def progress(sent, length):
+                print '%d%%' % (100 * sent / length)
+            db.put_attachment_file(doc, '/path/to/video.mp4', callback=progress)
+
+        :param doc: dict
+        :param f: path of the file or a file object. The file is sent from its current position.
+        :param name: name of attachment. Defaults to the name of the file if f is a path.
+        :param content_type: string, mimetype of attachment. If you don't set it, it will be autodetected.
+        :param chunk_size: Size in bytes of the reads from the file
+        :param callback: Optional function called as callback(bytes_sent, length) as the file is sent
+        :param refresh: See :meth:`put_attachment`
+
+        :return: bool, True if everything was ok.
+        """
+        is_path = isinstance(f, basestring)
+        if is_path:
+            if name is None:
+                name = os.path.basename(f)
+            f = open(f, 'rb')
+
+        try:
+            length = get_length(f)
+            if length is None:
+                raise InvalidAttachment("The length of the file must be known.")
+
+            body = FileBody(f, length, chunk_size, callback)
+            return self.put_attachment(doc, body, name, content_type, length, refresh)
+        finally:
+            if is_path:
+                f.close()
+
+    def delete_attachment(self, doc, name, refresh=True):
         """
         Delete attachment on the document
 
         :param doc: dict
         :param name: name of attachment (unicode or str)
+        :param refresh: If True get the saved document to update doc. If False update the `_rev`
+                and remove the attachment stub of doc, which saves a request.
 
         :return: dict, with member ok set to True if delete was ok.
         """
@@ -520,7 +1010,13 @@ class Database(object):
         resp = self._res(docid).delete(name, params={ 'rev': doc['_rev'] })
         res = resp.json_body
 
-        if res['ok']:
+        if res['ok'] and not refresh:
+            doc['_rev'] = res['rev']
+            attachments = doc.get('_attachments', {})
+            attachments.pop(name, None)
+            if not attachments:
+                doc.pop('_attachments', None)
+        elif res['ok']:
             new_doc = self.get_doc(doc['_id'], rev=res['rev'])
             doc.update(new_doc)
 
@@ -529,7 +1025,8 @@ class Database(object):
 
         return res['ok']
 
-    def fetch_attachment(self, id_or_doc, name, stream=False, stream_chunk_size=16 * 1024):
+    def fetch_attachment(self, id_or_doc, name, stream=False, stream_chunk_size=16 * 1024,
+                         offset=0, length=None):
         """
         Get an attachment in a document
         
@@ -540,23 +1037,180 @@ class Database(object):
         :param name: name of attachment (unicode or str)
         :param stream: boolean, if True return a file object
         :param stream_chunk_size: Size in bytes to return per stream chunk (default 16 * 1024)
+        :param offset: Position of the first byte to get. A Range request is sent when offset
+                or length is set.
+        :param length: Number of bytes to get or None to get the rest of the attachment
         
         :return: Bytestring or file like iterable if stream=True
+        :raise: ValueError if offset or length is negative
+
+        .. seealso:: :meth:`download_attachment` to save an attachment to a file
         """
 
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError("offset and length must not be negative")
+        if length == 0:
+            return ResponseStream(iter([])) if stream else ''
+
+        resp = self._get_attachment_response(id_or_doc, name, stream, offset, length)
+        is_whole = resp.status_int != 206 and (offset or length is not None)
+
+        if stream:
+            body = resp.body_stream(chunk_size=stream_chunk_size)
+            if is_whole:
+                # The range was ignored e.g. because CouchDB stores the attachment compressed
+                return ResponseStream(Database._slice_chunks(body, offset, length), body.close)
+            return body
+        
+        content = resp.body_string()
+        if is_whole:
+            end = None if length is None else offset + length
+            return content[offset:end]
+        return content
+
+    def _get_attachment_response(self, id_or_doc, name, stream, offset=0, length=None, is_retried=True):
         if isinstance(id_or_doc, basestring):
             docid = id_or_doc
         else:
             docid = id_or_doc['_id']
 
+        headers = None
+        if offset or length is not None:
+            end = '' if length is None else offset + length - 1
+            headers = {
+                'Range': 'bytes=%d-%s' % (offset, end),
+                'Accept-Encoding': 'identity', # So the range is of the attachment data
+            }
+
         docid = Database._escape_docid(docid)
         name = url_quote(name, safe="")
-        resp = self._res(docid).get(name, stream=stream)
-        if stream:
-            return resp.body_stream(chunk_size=stream_chunk_size)
-        
-        content = resp.body_string()
-        return content
+        res = self._res(docid)
+        if not is_retried:
+            res.retry = None
+        return res.get(name, headers=headers, stream=stream)
+
+    @staticmethod
+    def _slice_chunks(chunks, offset, length):
+        """ Yield the part of an iterable of str chunks from offset of length bytes """
+        position = 0
+        end = None if length is None else offset + length
+        for chunk in chunks:
+            start = position
+            position += len(chunk)
+            if position <= offset:
+                continue
+            if end is not None and start >= end:
+                break
+            yield chunk[max(offset - start, 0):None if end is None else end - start]
+
+    def download_attachment(self, id_or_doc, name, filename, chunk_size=64 * 1024,
+                            max_attempts=5, verify=True):
+        """
+        Save an attachment to a file, resuming where it stopped.
+
+        If the file exists it is treated as the start of the attachment and only the rest is
+        fetched with a Range request, so a failed download can be resumed by calling this again.
+        A download which fails with a connection error or timeout or which ends early is resumed up
+        to max_attempts times. The resumed requests are not also retried by the retry policy of the
+        server, which is only used for the delay between attempts. Errors writing the file are not
+        retried. Once complete the file is checked against the attachment stub. The md5 digest is
+        only checked if the attachment is not compressed because CouchDB finds the digest of
+        a compressed attachment after compressing it. Otherwise only the length is checked.
+
+        :param id_or_doc: str or dict, doc id or document dict. The stub is read from the document
+                dict if it has one with encoding info, otherwise the stub is fetched.
+        :param name: name of attachment (unicode or str)
+        :param filename: path of the file to write
+        :param chunk_size: Size in bytes of the writes to the file
+        :param max_attempts: The maximum number of attempts including the first
+        :param verify: If True check the file against the digest of the attachment
+        :return: dict, the attachment stub
+        :raise: :class:`couchdbreq.exceptions.AttachmentDigestMismatch` if the file does not match the
+                attachment. The file is left in place.
+        :raise: :class:`couchdbreq.exceptions.RequestError` if the last attempt failed
+        """
+        stub = None
+        if not isinstance(id_or_doc, basestring):
+            stub = id_or_doc.get('_attachments', {}).get(name)
+        if stub is None or 'length' not in stub or (verify and 'encoding' not in stub):
+            # Without the encoding info it is not known what the digest is of
+            stub = self._get_attachment_stub_with_encoding(id_or_doc, name)
+
+        retry = self._res.retry or RetryPolicy(max_attempts)
+        attempt = 0
+        while True:
+            attempt += 1
+            offset = os.path.getsize(filename) if os.path.exists(filename) else 0
+            if offset > stub['length']:
+                offset = 0 # Not a part of this attachment
+            if offset == stub['length'] and offset:
+                break
+
+            try:
+                self._download_attachment_from(id_or_doc, name, filename, offset, chunk_size)
+                if os.path.getsize(filename) < stub['length']:
+                    # The connection closed early without an error
+                    raise RequestError(IOError("Incomplete download of attachment %r" % name))
+                break
+            except RequestError:
+                if attempt >= max_attempts:
+                    raise
+                time.sleep(retry.get_delay(attempt))
+
+        if verify:
+            Database._verify_download(name, filename, stub)
+        return stub
+
+    def _get_attachment_stub_with_encoding(self, id_or_doc, name):
+        docid = id_or_doc if isinstance(id_or_doc, basestring) else id_or_doc['_id']
+        docid = Database._escape_docid(docid)
+        doc = self._res.get(docid, params={ 'att_encoding_info': 'true' }).json_body
+        attachments = doc.get('_attachments', {})
+        if name not in attachments:
+            raise ResourceNotFound("Document has no attachment %r" % name, 404)
+        return attachments[name]
+
+    def _download_attachment_from(self, id_or_doc, name, filename, offset, chunk_size):
+        resp = self._get_attachment_response(id_or_doc, name, True, offset, is_retried=False)
+        try:
+            # Start again if the whole attachment was sent
+            mode = 'ab' if resp.status_int == 206 else 'wb'
+            with open(filename, mode) as f:
+                for chunk in Database._iter_received(resp.body_stream(chunk_size)):
+                    f.write(chunk)
+        finally:
+            resp.close()
+
+    @staticmethod
+    def _iter_received(chunks):
+        """ Raise errors reading chunks of a response as RequestError so they are not mistaken for file errors """
+        chunks = iter(chunks)
+        while True:
+            try:
+                chunk = chunks.next()
+            except StopIteration:
+                return
+            except IOError as e: # Includes the exceptions of requests and socket errors
+                raise RequestError(e)
+            yield chunk
+
+    @staticmethod
+    def _verify_download(name, filename, stub):
+        md5 = hashlib.md5()
+        size = 0
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), ''):
+                md5.update(chunk)
+                size += len(chunk)
+
+        if size != stub['length']:
+            raise AttachmentDigestMismatch(name, 'length %d' % stub['length'], 'length %d' % size)
+
+        digest = stub.get('digest', '')
+        if 'encoding' not in stub and digest.startswith('md5-'):
+            actual = 'md5-' + base64.b64encode(md5.digest())
+            if actual != digest:
+                raise AttachmentDigestMismatch(name, digest, actual)
 
     def ensure_full_commit(self):
         """
@@ -582,11 +1236,19 @@ class Database(object):
         descending=False,
         filter=None,
         include_docs=False,
-        style="main_only"):
+        style="main_only",
+        feed="normal",
+        timeout=None):
         """
         Get changes from the db
         
-        Only feed=normal is supported because other feed types involve integration with a mainloop
+        Only feed=normal and feed=longpoll are supported because other feed types involve
+        integration with a mainloop
+
+        :param feed: "normal" or "longpoll". A longpoll request waits until there is a change
+                after since or until timeout.
+        :param timeout: Milliseconds a longpoll request waits for a change. Must be shorter than
+                the timeout of the server.
         """
         
         params = {
@@ -596,6 +1258,8 @@ class Database(object):
             'filter': filter,
             'include_docs': include_docs,
             'style': style,
+            'feed': feed,
+            'timeout': timeout,
         }
         response = self._res.get("_changes", params=params).json_body
         for row in response['results']:
@@ -48,6 +48,7 @@ class ResourceError(CouchException):
     """
 
     status_int = None
+    attempts = 1 # The number of times the request was sent
     
     def __init__(self, msg=None, http_code=None, response=None):
         self.msg = msg or ''
@@ -76,6 +77,13 @@ class ResourceError(CouchException):
         error_type = _ExceptionMap.get(status_code, RequestFailed)
         return error_type(resp.content, http_code=status_code, response=resp)
 
+    @staticmethod
+    def create_from_bulk_result(result):
+        """ Create the exception for an error row of a _bulk_docs response """
+        status_code = _BulkErrorMap.get(result['error'])
+        error_type = _ExceptionMap.get(status_code, RequestFailed)
+        return error_type(result.get('reason'), http_code=status_code)
+
 class ResourceNotFound(ResourceError):
     """Exception raised when no resource was found at the given url. 
     """
@@ -123,12 +131,30 @@ _ExceptionMap = {
     412: PreconditionFailed,
 }
 
+_BulkErrorMap = {
+    'unauthorized': 401,
+    'forbidden': 403,
+    'not_found': 404,
+    'conflict': 409,
+}
+
 class DatabaseExistsException(CouchException):
     """ Exception raised when a database already exists """
 
 class InvalidAttachment(CouchException):
     """ raised when an attachment is invalid """
 
+class AttachmentDigestMismatch(CouchException):
+    """ raised when downloaded attachment data does not match the digest of the attachment """
+
+    def __init__(self, name, expected, actual):
+        self.name = name
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return "Attachment %r has digest %s, expected %s" % (self.name, self.actual, self.expected)
+
 class MultipleResultsFound(CouchException):
     """ exception raised when more than one object is
     returned by the get_by method"""
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import threading
+
+from bisect import bisect_left
+
+class RequestInfo(object):
+    """
+    Describes one HTTP request made to CouchDB. Passed to each observer before and after
+    the request. The response fields are None in before_request.
+
+    :ivar method: The HTTP method
+    :ivar uri: The full uri including the query string
+    :ivar path_template: The path with names replaced by * e.g. `*/_design/*/_view/*`
+    :ivar operation: A name for the kind of request e.g. `view`, `save_doc` or `attachment`
+    :ivar bytes_sent: Size of the request body or None if unknown
+    :ivar status: The HTTP status or None if the request failed without a response
+    :ivar bytes_received: Size of the response body or None if unknown
+    :ivar time_to_headers: Seconds until the response headers were received
+    :ivar time_to_last_byte: Seconds until the response body was received. None for
+        streamed responses.
+    :ivar error: The exception raised if the request failed without a response
+    """
+
+    def __init__(self, method, uri, path_template, bytes_sent):
+        self.method = method
+        self.uri = uri
+        self.path_template = path_template
+        self.operation = get_operation(method, path_template)
+        self.bytes_sent = bytes_sent
+
+        self.status = None
+        self.bytes_received = None
+        self.time_to_headers = None
+        self.time_to_last_byte = None
+        self.error = None
+
+class Observer(object):
+    """
+    Base class for request observers. Add an observer with :meth:`couchdbreq.Server.add_observer`.
+
+    Observers are called on the thread making the request so they must be thread safe and fast.
+    """
+
+    def before_request(self, info):
+        """ :param info: :class:`couchdbreq.instrument.RequestInfo` """
+
+    def after_request(self, info):
+        """ :param info: :class:`couchdbreq.instrument.RequestInfo` """
+
+def get_path_template(path):
+    """
+    Replace the names in a path relative to the server with * keeping special
+    segments starting with _ e.g. `mydb/_design/app/_view/all` is `*/_design/*/_view/*`
+    """
+    path = path.split('?', 1)[0].strip('/')
+    if not path:
+        return ''
+    return '/'.join(s if s.startswith('_') else '*' for s in path.split('/'))
+
+_DOC_OPERATIONS = {
+    'GET': 'get_doc',
+    'HEAD': 'head_doc',
+    'PUT': 'save_doc',
+    'DELETE': 'delete_doc',
+    'COPY': 'copy_doc',
+}
+
+# Server level endpoints. Any other first segment is a database e.g. _users and _replicator
+_SERVER_ENDPOINTS = frozenset([
+    '_active_tasks',
+    '_all_dbs',
+    '_cluster_setup',
+    '_config',
+    '_db_updates',
+    '_dbs_info',
+    '_log',
+    '_membership',
+    '_node',
+    '_replicate',
+    '_restart',
+    '_scheduler',
+    '_session',
+    '_stats',
+    '_up',
+    '_utils',
+    '_uuids',
+])
+
+def get_operation(method, path_template):
+    """ Name the kind of request so latency can be split by operation """
+    segments = path_template.split('/') if path_template else []
+    if not segments:
+        return 'server'
+    if segments[0] in _SERVER_ENDPOINTS:
+        return segments[0][1:]
+    if len(segments) == 1:
+        return 'database'
+
+    if segments[1] in ('_design', '_local'):
+        # Design and local docs have two segment ids
+        if '_view' in segments:
+            return 'view'
+        if '_info' in segments:
+            return 'view_info'
+        doc_segments = segments[3:]
+    else:
+        if segments[1] != '*':
+            return segments[1][1:] # e.g. _bulk_docs, _all_docs, _changes
+        doc_segments = segments[2:]
+
+    if doc_segments:
+        return 'attachment'
+    return _DOC_OPERATIONS.get(method, 'doc')
+
+class LatencyCollector(Observer):
+    """
+    Keeps per operation latency histograms and counters.
+
+    Add to a server with :meth:`couchdbreq.Server.add_observer` and call
+    :meth:`export_text` to get the metrics in the Prometheus text exposition format.
+
+    :param buckets: Upper bounds of the histogram buckets in seconds
+    :param prefix: Prefix of the metric names
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='couchdbreq'):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._durations = {} # operation -> _Histogram
+        self._headers = {} # operation -> _Histogram
+        self._requests = {} # (operation, method, status) -> count
+        self._bytes_sent = {} # operation -> bytes
+        self._bytes_received = {} # operation -> bytes
+
+    def after_request(self, info):
+        operation = info.operation
+        duration = info.time_to_last_byte
+        if duration is None:
+            duration = info.time_to_headers
+
+        with self._lock:
+            if duration is not None:
+                self._observe(self._durations, operation, duration)
+            if info.time_to_headers is not None:
+                self._observe(self._headers, operation, info.time_to_headers)
+
+            key = (operation, info.method, info.status if info.status is not None else 'error')
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+            if info.bytes_sent:
+                self._bytes_sent[operation] = self._bytes_sent.get(operation, 0) + info.bytes_sent
+            if info.bytes_received:
+                self._bytes_received[operation] = self._bytes_received.get(operation, 0) + info.bytes_received
+
+    def _observe(self, histograms, operation, value):
+        histogram = histograms.get(operation)
+        if histogram is None:
+            histogram = histograms[operation] = _Histogram(self.buckets)
+        histogram.observe(value)
+
+    def get_stats(self):
+        """
+        :return: dict of operation to a dict with count, sum and avg of the request durations
+        """
+        with self._lock:
+            return dict((operation, {
+                'count': h.count,
+                'sum': h.sum,
+                'avg': h.sum / h.count if h.count else 0.0,
+            }) for operation, h in self._durations.iteritems())
+
+    def export_text(self):
+        """
+        :return: str, the metrics in the Prometheus text exposition format
+        """
+        prefix = self.prefix
+        lines = []
+        with self._lock:
+            self._export_histograms(lines, '%s_request_duration_seconds' % prefix,
+                'Time to the last byte of CouchDB requests', self._durations)
+            self._export_histograms(lines, '%s_time_to_headers_seconds' % prefix,
+                'Time to the response headers of CouchDB requests', self._headers)
+
+            name = '%s_requests_total' % prefix
+            lines.append('# HELP %s Number of CouchDB requests' % name)
+            lines.append('# TYPE %s counter' % name)
+            for (operation, method, status), count in sorted(self._requests.iteritems()):
+                lines.append('%s{operation="%s",method="%s",status="%s"} %d' % (name, operation, method, status, count))
+
+            for direction, counts in (('sent', self._bytes_sent), ('received', self._bytes_received)):
+                name = '%s_bytes_%s_total' % (prefix, direction)
+                lines.append('# HELP %s Body bytes %s' % (name, direction))
+                lines.append('# TYPE %s counter' % name)
+                for operation, count in sorted(counts.iteritems()):
+                    lines.append('%s{operation="%s"} %d' % (name, operation, count))
+
+        return '\n'.join(lines) + '\n'
+
+    def _export_histograms(self, lines, name, help, histograms):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+        for operation, h in sorted(histograms.iteritems()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, h.counts):
+                cumulative += count
+                lines.append('%s_bucket{operation="%s",le="%s"} %d' % (name, operation, bound, cumulative))
+            lines.append('%s_bucket{operation="%s",le="+Inf"} %d' % (name, operation, h.count))
+            lines.append('%s_sum{operation="%s"} %s' % (name, operation, repr(h.sum)))
+            lines.append('%s_count{operation="%s"} %d' % (name, operation, h.count))
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets) # Values over the last bound are only in count
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
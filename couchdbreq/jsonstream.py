@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import re
+import json
+
+_SKIP = re.compile(r'[\s,:]*')
+_STRUCT = re.compile(r'[\[\]{}"]')
+_STRING = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[\s,\]}]')
+
+_QUOTE = ord('"')
+_BACKSLASH = ord('\\')
+_LBRACE = ord('{')
+_RBRACE = ord('}')
+_LBRACKET = ord('[')
+_RBRACKET = ord(']')
+
+# Drop consumed bytes from the front of the buffer once this many have been parsed
+_TRIM_SIZE = 64 * 1024
+
+class JsonStreamParser(object):
+    """
+    Incrementally parse a JSON document read from an iterable of byte chunks.
+
+    The elements of one array are yielded one at a time so that memory use is bounded
+    by the size of the largest element rather than the size of the document. When
+    array_key is given the document must be an object and the elements of the array
+    stored under that key are yielded. All other members of the object are decoded
+    and stored in `meta` as they are parsed. When array_key is None the document
+    itself must be an array.
+
+    :param chunks: iterable of str
+    :param array_key: The key of the array to stream or None for a top level array
+    :param loads: Function used to decode each element
+    """
+
+    def __init__(self, chunks, array_key='rows', loads=json.loads):
+        self.meta = {}
+
+        self._chunks = iter(chunks)
+        self._array_key = array_key
+        self._loads = loads
+        self._buf = bytearray()
+        self._pos = 0
+
+    def __iter__(self):
+        if self._array_key is None:
+            for value in self._iter_array():
+                yield value
+            return
+
+        self._expect(_LBRACE)
+        while True:
+            self._skip()
+            if self._buf[self._pos] == _RBRACE:
+                self._pos += 1
+                return
+
+            key = self._value()
+            self._skip()
+            if key == self._array_key and self._buf[self._pos] == _LBRACKET:
+                for value in self._iter_array():
+                    yield value
+            else:
+                self.meta[key] = self._value()
+
+    def _iter_array(self):
+        self._expect(_LBRACKET)
+        while True:
+            self._skip()
+            if self._buf[self._pos] == _RBRACKET:
+                self._pos += 1
+                return
+
+            value = self._value()
+            self._trim()
+            yield value
+
+    def _fill(self):
+        for chunk in self._chunks:
+            if chunk:
+                self._buf.extend(chunk)
+                return True
+        return False
+
+    def _trim(self):
+        if self._pos >= _TRIM_SIZE:
+            del self._buf[:self._pos]
+            self._pos = 0
+
+    def _skip(self):
+        """ Advance past whitespace and separators. There must be more data. """
+        while True:
+            self._pos = _SKIP.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def _expect(self, c):
+        self._skip()
+        if self._buf[self._pos] != c:
+            raise ValueError("Expected '%s' at position %s of JSON stream" % (chr(c), self._pos))
+        self._pos += 1
+
+    def _value(self):
+        """ Decode the value starting at the current position """
+        start = self._pos
+        c = self._buf[start]
+        if c == _LBRACE or c == _LBRACKET:
+            end = self._struct_end(start)
+        elif c == _QUOTE:
+            end = self._string_end(start)
+        else:
+            end = self._scalar_end(start)
+        self._pos = end
+        return self._loads(str(self._buf[start:end]))
+
+    def _struct_end(self, i):
+        buf = self._buf
+        depth = 0
+        while True:
+            m = _STRUCT.search(buf, i)
+            if m is None:
+                i = len(buf)
+                if not self._fill():
+                    raise ValueError("Unexpected end of JSON stream")
+                continue
+
+            i = m.start()
+            c = buf[i]
+            if c == _QUOTE:
+                i = self._string_end(i)
+                continue
+
+            if c == _LBRACE or c == _LBRACKET:
+                depth += 1
+            else:
+                depth -= 1
+            i += 1
+            if depth == 0:
+                return i
+
+    def _string_end(self, i):
+        buf = self._buf
+        i += 1
+        while True:
+            m = _STRING.search(buf, i)
+            if m is None:
+                # i may point past the end if the last byte was an escape
+                i = max(i, len(buf))
+                if not self._fill():
+                    raise ValueError("Unexpected end of JSON stream")
+                continue
+
+            i = m.start()
+            if buf[i] == _BACKSLASH:
+                i += 2
+                continue
+            return i + 1
+
+    def _scalar_end(self, i):
+        buf = self._buf
+        while True:
+            m = _SCALAR_END.search(buf, i)
+            if m is not None:
+                return m.start()
+            i = len(buf)
+            if not self._fill():
+                return i
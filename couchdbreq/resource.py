@@ -4,69 +4,229 @@
 # See the NOTICE for more information.
 
 import requests
-import json
 import socket
+import time
+
+from collections import deque
 
 from . import __version__
 
+from .body import GzipBody, JsonArrayBody, EncodedJson, is_replayable
+from .codec import JsonCodec
 from .exceptions import RequestError, ResourceError, Timeout
+from .instrument import RequestInfo, get_path_template
 from .utils import make_uri
 
 USER_AGENT = 'couchdbreq/%s' % __version__
 
 class ResponseStream(object):
-    
-    def __init__(self, it):
+    """
+    A file like object reading from an iterator of str chunks.
+
+    Chunks are buffered in a deque and only sliced when a read ends part way through
+    a chunk, so every byte is copied at most twice however small the reads are.
+    readinto() copies straight from the chunks into a caller supplied buffer.
+    Iterating over the stream yields the remaining data in chunks.
+
+    :param it: iterator of str chunks
+    :param close: Optional function called to release the underlying response
+    """
+
+    def __init__(self, it, close=None):
         self.iter = it
-        self.buf = ""
+        self._close = close
+        self._chunks = deque()
+        self._offset = 0 # Offset of the first unread byte in self._chunks[0]
+        self._buffered = 0 # Number of unread bytes in self._chunks
 
     def __enter__(self):
         return self
 
     def __exit__(self, with_type, value, traceback):
-        pass # FIXME: Tidy up ??
-    
+        self.close()
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+    def readable(self):
+        return True
+
     def __iter__(self):
-        return self.iter
-    
+        while self._chunks:
+            yield self._popleft()
+        for chunk in self.iter:
+            if chunk:
+                yield chunk
+
+    def _fill(self, size):
+        """ Buffer chunks until at least size bytes are available or the iterator is exhausted """
+        while size is None or size < 0 or self._buffered < size:
+            try:
+                chunk = self.iter.next()
+            except StopIteration:
+                return
+            if chunk:
+                self._chunks.append(chunk)
+                self._buffered += len(chunk)
+
+    def _popleft(self):
+        """ Remove and return the unread part of the first chunk """
+        chunk = self._chunks.popleft()
+        if self._offset:
+            chunk = chunk[self._offset:]
+            self._offset = 0
+        self._buffered -= len(chunk)
+        return chunk
+
+    def _take(self, size):
+        """ Remove and return a list of pieces holding the next size buffered bytes """
+        pieces = []
+        while size > 0 and self._chunks:
+            chunk = self._chunks[0]
+            available = len(chunk) - self._offset
+            if available <= size:
+                pieces.append(self._popleft())
+                size -= available
+            else:
+                pieces.append(chunk[self._offset:self._offset + size])
+                self._offset += size
+                self._buffered -= size
+                size = 0
+        return pieces
+
     def read(self, size=None):
-        buf = self.buf
-        
-        # If we have enought data already then we are done
-        if size and len(buf) >= size:
-            ret = buf[:size]
-            self.buf = buf[size:]
-            return ret
-        
-        # Look for more data
-        for chunk in self:
-            buf += chunk
-            
-            if size and len(buf) >= size:
-                break
-
-        # Return at most size bytes
-        ret = buf[:size]
-        self.buf = buf[size:]
-        return ret
-        
+        if size is not None and size < 0:
+            size = None
+        self._fill(size)
+
+        if size is None or size > self._buffered:
+            size = self._buffered
+        pieces = self._take(size)
+
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+    def readinto(self, b):
+        """
+        Read up to len(b) bytes into the writable buffer b.
+
+        :return: The number of bytes read. 0 at the end of the stream.
+        """
+        target = memoryview(b)
+        size = len(target)
+        self._fill(size)
+
+        n = 0
+        while n < size and self._chunks:
+            chunk = self._chunks[0]
+            k = min(size - n, len(chunk) - self._offset)
+            target[n:n + k] = memoryview(chunk)[self._offset:self._offset + k]
+            n += k
+            self._offset += k
+            self._buffered -= k
+            if self._offset == len(chunk):
+                self._chunks.popleft()
+                self._offset = 0
+        return n
+
+    def readline(self, size=None):
+        """ Read up to and including the next newline or at most size bytes """
+        if size is not None and size < 0:
+            size = None
+
+        searched = 0
+        while True:
+            length = self._find_newline(searched)
+            if length == -1:
+                if size is not None and self._buffered >= size:
+                    length = size
+                else:
+                    searched = before = self._buffered
+                    self._fill(before + 1)
+                    if self._buffered > before:
+                        continue
+                    length = before
+
+            if size is not None:
+                length = min(length, size)
+            return ''.join(self._take(length))
+
+    def _find_newline(self, start):
+        """ Return the number of buffered bytes up to and including the first newline after start or -1 """
+        seen = 0
+        offset = self._offset
+        for chunk in self._chunks:
+            available = len(chunk) - offset
+            if seen + available > start:
+                pos = chunk.find('\n', offset + max(0, start - seen))
+                if pos != -1:
+                    return seen + pos - offset + 1
+            seen += available
+            offset = 0
+        return -1
+
+class BufferedResponse(object):
+    """
+    A response which has been fully received by a transport other than the session.
+    It has the parts of a requests.Response used by CouchDBResponse and ResourceError.
+
+    :param status: int, the HTTP status code
+    :param headers: dict of response headers
+    :param body: str, the response body
+    """
+
+    def __init__(self, status, headers, body):
+        self.status_code = status
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.content = body
+
+    def iter_content(self, chunk_size=1):
+        for i in xrange(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
 class CouchDBResponse(object):
+    """
+    :param release_body: If True then drop the raw response once json_body has been parsed
+            so that only the decoded body is kept in memory.
+    """
 
-    def __init__(self, response):
+    def __init__(self, response, codec, release_body=False):
         self.response = response
+        self.codec = codec
+        self.release_body = release_body
         self.status_int = response.status_code
         self.headers = response.headers
 
+        self._json_body = None
+        self._is_json_parsed = False
+
     @property
     def json_body(self):
-        body = self.response.content
-        return json.loads(body)
+        """ The decoded body. The body is only decoded once. """
+        if not self._is_json_parsed:
+            self._json_body = self.codec.loads(self.response.content)
+            self._is_json_parsed = True
+
+            if self.release_body:
+                self.response = None
+        return self._json_body
 
     def body_string(self):
+        if self.response is None:
+            raise ValueError("The raw body has been released")
         return self.response.content
  
     def body_stream(self, chunk_size):
-        return ResponseStream(self.response.iter_content(chunk_size=chunk_size))
+        return ResponseStream(self.response.iter_content(chunk_size=chunk_size), self.close)
+
+    def close(self):
+        """ Release the connection of a streamed response back to the pool """
+        self.response.close()
 
 class CouchdbResource(object):
 
@@ -75,10 +235,19 @@ class CouchdbResource(object):
     charset = 'utf-8' # FIXME: Remove?
     response_class = CouchDBResponse
 
-    def __init__(self, session, uri, timeout):
+    def __init__(self, session, uri, timeout, codec=None, release_body=False, retry=None,
+                 nodes=None, root=None, observers=None, compress_threshold=None, single_flight=None):
         self.session = session
         self.uri = uri
+        self.root = root or uri # The uri of the server
+        self.nodes = nodes
+        self.observers = observers if observers is not None else []
+        self.compress_threshold = compress_threshold
+        self.single_flight = single_flight
         self.timeout = timeout
+        self.codec = codec or JsonCodec()
+        self.release_body = release_body
+        self.retry = retry
 
     def copy(self, path=None, headers=None, params=None, stream=False):
         """ add copy to HTTP verbs """
@@ -99,11 +268,12 @@ class CouchdbResource(object):
         return self.request("POST", path=path, payload=payload, 
                         headers=headers, params=params, stream=stream)
 
-    def put(self, path=None, payload=None, headers=None, params=None, stream=False):
+    def put(self, path=None, payload=None, headers=None, params=None, stream=False, idempotent=False):
         return self.request("PUT", path=path, payload=payload,
-                        headers=headers, params=params, stream=stream)
+                        headers=headers, params=params, stream=stream, idempotent=idempotent)
 
-    def request(self, method, path=None, payload=None, headers=None, params=None, stream=False):
+    def request(self, method, path=None, payload=None, headers=None, params=None, stream=False,
+                idempotent=False):
         """
         Perform HTTP call to the couchdb server and manage
 
@@ -114,42 +284,230 @@ class CouchdbResource(object):
             be added to HTTP request.
         @param params: Optional parameters added to the request.
         @param stream Should the request be streamed
+        @param idempotent Set to True if the request may be retried even though
+            the method is not safe
         @return: response object
         """
 
+        uri, payload, headers = self.prepare(path, payload, headers, params)
+
+        if self.single_flight is not None and method == 'GET' and not stream:
+            # Identical concurrent reads share one HTTP request. Each caller wraps and
+            # decodes the shared response itself so callers can modify their results.
+            key = (uri, frozenset(headers.iteritems()))
+            resp, attempt = self.single_flight.do(key,
+                lambda: self._send_with_policy(method, uri, payload, headers, stream, idempotent))
+        else:
+            resp, attempt = self._send_with_policy(method, uri, payload, headers, stream, idempotent)
+
+        return self._make_response(resp, attempt)
+
+    def _send_with_policy(self, method, uri, payload, headers, stream, idempotent):
+        """ Send the request retrying if allowed. Returns the response and number of attempts. """
+        retry = self.retry
+        if retry is not None:
+            if not retry.is_retryable_method(method, idempotent):
+                retry = None
+            elif not is_replayable(payload):
+                retry = None # A file like payload cannot be sent twice
+
+        if retry is None:
+            return self._send(method, uri, payload, headers, stream, self.timeout), 1
+        return self._send_with_retry(retry, method, uri, payload, headers, stream)
+
+    def prepare(self, path=None, payload=None, headers=None, params=None):
+        """
+        Encode a request without sending it.
+
+        This is all of the request handling which does not depend on the transport.
+        A transport other than the session, for example one integrated with a mainloop,
+        should use this and make_response() so that encoding matches the session transport.
+
+        The returned payload is one of:
+
+        - None
+        - str
+        - an object with read() like a file. If it has __len__ the length is known in
+          advance, e.g. FileBody and MultipartRelatedBody. Otherwise send it chunked.
+        - an iterable of str chunks of unknown length which must be sent with chunked
+          transfer encoding, e.g. GzipBody and JsonArrayBody
+
+        @return: tuple of (uri, payload, headers)
+        """
         headers = headers or {}
         headers.setdefault('Accept', 'application/json')
         headers.setdefault('User-Agent', USER_AGENT)
 
+        is_json = False
         if payload is not None:
             #TODO: handle case we want to put in payload json file.
-            if not hasattr(payload, 'read') and not isinstance(payload, basestring):
-                payload = json.dumps(payload).encode('utf-8')
+            if isinstance(payload, (EncodedJson, JsonArrayBody)):
+                is_json = True
+            elif not hasattr(payload, 'read') and not isinstance(payload, basestring):
+                payload = self.codec.dumps(payload)
+                is_json = True
+
+            if is_json:
                 headers.setdefault('Content-Type', 'application/json')
 
             if isinstance(payload, unicode):
                 payload = payload.encode(self.charset)
-        
+
+        if self.compress_threshold is not None:
+            headers.setdefault('Accept-Encoding', 'gzip')
+            # Only json is compressed. Other bodies such as attachments would be stored compressed.
+            # The size of a streamed body is not known so it is always compressed.
+            is_large = is_json and (isinstance(payload, JsonArrayBody)
+                                    or len(payload) >= self.compress_threshold)
+            if is_large and 'Content-Encoding' not in headers:
+                payload = GzipBody(payload)
+                headers['Content-Encoding'] = 'gzip'
+                for name in headers.keys():
+                    if name.lower() == 'content-length':
+                        del headers[name] # The compressed body is sent chunked
+
         params = self._encode_params(params)
         uri = make_uri((self.uri, path), params=params, charset=self.charset, 
                        safe=self.safe, encode_keys=self.encode_keys)
 
+        return uri, payload, headers
+
+    def make_response(self, status, headers, body, attempts=1):
+        """
+        Check the status of a response received by a transport other than the session and wrap it.
+
+        @param status: int, the HTTP status code
+        @param headers: dict of response headers
+        @param body: str, the response body
+        @param attempts: The number of times the request was sent
+        @raise: ResourceError if the status is an error
+        @return: response object
+        """
+        return self._make_response(BufferedResponse(status, headers, body), attempts)
+
+    def _make_response(self, resp, attempts=1):
+        """ Check the status of a requests.Response and wrap it. """
+        if resp.status_code >= 400:
+            e = ResourceError.create_from_response(resp)
+            e.attempts = attempts
+            raise e
+
+        return self.response_class(resp, self.codec, self.release_body)
+
+    def _send(self, method, uri, payload, headers, stream, timeout):
+        nodes = self.nodes
+        if nodes is None:
+            return self._send_observed(method, uri, self.root, payload, headers, stream, timeout)
+
+        node = nodes.acquire()
+        uri = node.uri + uri[len(self.root):]
+        start = time.time()
+        resp = None
+        try:
+            resp = self._send_observed(method, uri, node.uri, payload, headers, stream, timeout)
+        finally:
+            # Any exception without a response counts as a failure of the node
+            if resp is None:
+                nodes.release(node, is_failure=True)
+            else:
+                nodes.release(node, time.time() - start, is_failure=resp.status_code >= 500)
+        return resp
+
+    def _send_observed(self, method, uri, root, payload, headers, stream, timeout):
+        observers = self.observers
+        if not observers:
+            return self._send_to_node(method, uri, payload, headers, stream, timeout)
+
+        if isinstance(payload, basestring):
+            bytes_sent = len(payload)
+        elif 'Content-Length' in headers:
+            bytes_sent = int(headers['Content-Length'])
+        else:
+            bytes_sent = None
+        info = RequestInfo(method, uri, get_path_template(uri[len(root):]), bytes_sent)
+        for observer in observers:
+            observer.before_request(info)
+
+        start = time.time()
         try:
-            resp = self.session.request(method, url=uri,
-                             data=payload, headers=headers, stream=stream, timeout=self.timeout)
+            resp = self._send_to_node(method, uri, payload, headers, stream, timeout)
+        except RequestError as e:
+            info.error = e
+            info.time_to_last_byte = time.time() - start
+        else:
+            info.status = resp.status_code
+            info.time_to_headers = resp.elapsed.total_seconds()
+            if stream:
+                length = resp.headers.get('Content-Length')
+                info.bytes_received = int(length) if length else None
+            else:
+                info.time_to_last_byte = time.time() - start
+                info.bytes_received = len(resp.content)
+
+        try:
+            for observer in observers:
+                observer.after_request(info)
+        except Exception:
+            if info.error is None:
+                resp.close() # A streamed response would otherwise hold its connection
+            raise
+
+        if info.error is not None:
+            raise info.error
+        return resp
+
+    def _send_to_node(self, method, uri, payload, headers, stream, timeout):
+        try:
+            return self.session.request(method, url=uri,
+                             data=payload, headers=headers, stream=stream, timeout=timeout)
         except requests.ConnectionError as e:
             raise RequestError(e)
         except socket.timeout as e:
-            raise Timeout(e, self.timeout, uri)
+            raise Timeout(e, timeout, uri)
         except requests.Timeout as e:
-            raise Timeout(e, self.timeout, uri)
-
-        status_code = resp.status_code
-
-        if status_code >= 400:
-            raise ResourceError.create_from_response(resp)
-
-        return self.response_class(resp)
+            raise Timeout(e, timeout, uri)
+
+    def _send_with_retry(self, retry, method, uri, payload, headers, stream):
+        """ Send the request retrying according to the policy. Returns the response and number of attempts. """
+        deadline = None
+        if retry.deadline is not None:
+            deadline = time.time() + retry.deadline
+
+        attempt = 0
+        error = resp = None # The result of the previous attempt
+        while True:
+            if deadline is not None and attempt and deadline - time.time() <= 0:
+                # The deadline passed during the delay so the previous attempt is the result
+                if error is not None:
+                    raise error
+                return resp, attempt
+            if resp is not None:
+                resp.close()
+            attempt += 1
+
+            timeout = self.timeout
+            if deadline is not None and timeout is not None:
+                timeout = min(timeout, deadline - time.time())
+
+            is_last = attempt >= retry.max_attempts
+            try:
+                resp = self._send(method, uri, payload, headers, stream, timeout)
+                error = None
+            except RequestError as e:
+                if is_last:
+                    raise
+                delay = retry.get_delay(attempt)
+                if deadline is not None and time.time() + delay >= deadline:
+                    raise
+                error, resp = e, None
+            else:
+                if is_last or resp.status_code not in retry.retry_statuses:
+                    return resp, attempt
+                delay = retry.get_delay(attempt)
+                if deadline is not None and time.time() + delay >= deadline:
+                    return resp, attempt
+
+            time.sleep(delay)
     
     def __call__(self, path, safe=None):
         """ Create a sub resource using the same session. """
@@ -160,7 +518,9 @@ class CouchdbResource(object):
         new_uri = make_uri((self.uri, path), charset=self.charset, 
                         safe=safe, encode_keys=self.encode_keys)
 
-        return CouchdbResource(self.session, new_uri, self.timeout)
+        return CouchdbResource(self.session, new_uri, self.timeout, self.codec, self.release_body,
+                               self.retry, self.nodes, self.root, self.observers,
+                               self.compress_threshold, self.single_flight)
     
     
     _JSON_PARAMS = (
@@ -192,7 +552,7 @@ class CouchdbResource(object):
                     continue
                 
                 if name in CouchdbResource._JSON_PARAMS:
-                    value = json.dumps(value)
+                    value = self.codec.dumps(value)
                 elif name in CouchdbResource._BOOLEAN_PARAMS:
                     if value:
                         value = 'true'
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdb-requests released under the MIT license.
+# See the NOTICE for more information.
+
+import random
+
+class RetryPolicy(object):
+    """
+    Configures how failed requests are retried.
+
+    A request is retried when it fails with a connection error, a timeout or one of
+    retry_statuses. Only methods in retry_methods are retried, plus requests which the
+    library knows are idempotent, such as saving a document with an explicit `_id`.
+    Request bodies read from a file or generator are never retried because they cannot be
+    sent twice.
+
+    The delay before attempt n + 1 is backoff * 2 ** (n - 1) capped at max_backoff.
+    With jitter the delay is chosen uniformly between 0 and that value so that clients
+    retrying at the same time spread out.
+
+    :param max_attempts: The maximum number of attempts including the first
+    :param backoff: Delay in seconds before the first retry
+    :param max_backoff: Maximum delay in seconds between attempts
+    :param jitter: bool, randomize the delay
+    :param retry_statuses: HTTP status codes which are retried
+    :param deadline: Maximum number of seconds to spend on one call including all
+            retries or None for no limit
+    :param retry_methods: HTTP methods which are safe to retry
+    """
+
+    def __init__(self,
+        max_attempts=3,
+        backoff=0.1,
+        max_backoff=5.0,
+        jitter=True,
+        retry_statuses=(500, 502, 503, 504),
+        deadline=None,
+        retry_methods=('GET', 'HEAD')):
+
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = frozenset(retry_statuses)
+        self.deadline = deadline
+        self.retry_methods = frozenset(retry_methods)
+
+    def get_delay(self, attempt):
+        """
+        :param attempt: The number of attempts made so far
+        :return: Number of seconds to wait before the next attempt
+        """
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def is_retryable_method(self, method, idempotent=False):
+        return idempotent or method in self.retry_methods
@@ -10,37 +10,125 @@ from .exceptions import ResourceNotFound
 from .utils import url_quote
 from .database import Database
 from .resource import CouchdbResource
+from .balancer import NodeSet
+from .adapter import PoolAdapter, make_socket_options
+from .singleflight import SingleFlight
 
 class Session(requests.Session):
     """
     The http session for a server to use.
 
     See `http://docs.python-requests.org/en/latest/api/#sessionapi`.
+
+    Size pool_maxsize to the number of threads sharing the session. With pool_block=False
+    a thread finding every connection in use opens an extra connection which is closed
+    after the request instead of being returned to the pool.
+
+    :param pool_connections: Number of connection pools to cache (one pool per host)
+    :param pool_maxsize: Maximum number of connections kept open per pool
+    :param pool_block: If True then wait for a free connection when the pool is exhausted
+    :param tcp_nodelay: Disable Nagle's algorithm on new sockets
+    :param tcp_keepalive: Enable TCP keepalive on new sockets
+    :param socket_options: list of additional (level, option, value) tuples set on new sockets
     """
 
+    def __init__(self,
+        pool_connections=10,
+        pool_maxsize=10,
+        pool_block=False,
+        tcp_nodelay=True,
+        tcp_keepalive=False,
+        socket_options=None):
+
+        requests.Session.__init__(self)
+
+        self.pool_maxsize = pool_maxsize
+
+        options = make_socket_options(tcp_nodelay, tcp_keepalive, socket_options)
+        self._adapter = PoolAdapter(pool_connections, pool_maxsize, pool_block, options)
+        self.mount('http://', self._adapter)
+        self.mount('https://', self._adapter)
+
+    def get_pool_metrics(self):
+        """
+        Get connection pool usage
+
+        :return: dict, see :meth:`couchdbreq.adapter.PoolMetrics.snapshot`
+        """
+        return self._adapter.metrics.snapshot()
+
 class Server(object):
     """
     A Server object represents the connection to the CouchDB database.
 
-    :param uri: URI of the server
+    To spread requests over the nodes of a cluster pass a list of node uris::
+
+        server = Server(["http://db1:5984", "http://db2:5984", "http://db3:5984"],
+                        strategy=LeastOutstandingStrategy())
+
+    :param uri: URI of the server or a list of URIs of the nodes of a cluster
     :param session: A :class:`couchdbreq.Session` object. Use this to configure the
             connection parameters such as timeout, connection pool size and authentication.
+    :param codec: A :class:`couchdbreq.codec.JsonCodec` used to encode and decode json.
+            Defaults to the json module from the standard library.
+    :param release_body: If True then the raw bytes of a response are released as soon as the
+            response has been decoded. This reduces peak memory when holding large results.
+    :param retry: A :class:`couchdbreq.retry.RetryPolicy` used to retry failed requests.
+            By default requests are not retried.
+    :param strategy: Chooses the node for each request when uri is a list. One of
+            :class:`couchdbreq.balancer.RoundRobinStrategy` (the default),
+            :class:`couchdbreq.balancer.LeastOutstandingStrategy` or
+            :class:`couchdbreq.balancer.EwmaStrategy`.
+    :param observers: list of :class:`couchdbreq.instrument.Observer` called before and after
+            every request. See :meth:`add_observer`.
+    :param compress_threshold: If set then request bodies of at least this many bytes are
+            sent gzip compressed and gzip compressed responses are always requested.
+            Compression is streamed so the compressed body is never held in memory.
+    :param coalesce_reads: If True then identical GET requests made concurrently by several
+            threads share one HTTP request. This protects the server from bursts of identical
+            reads e.g. when a popular cached document expires.
     """
     uuid_batch_count = 1000
     
-    def __init__(self, uri='http://127.0.0.1:5984', session=None, timeout=5):
+    def __init__(self, uri='http://127.0.0.1:5984', session=None, timeout=5, codec=None, release_body=False,
+                 retry=None, strategy=None, observers=None, compress_threshold=None,
+                 coalesce_reads=False):
 
-        if uri.endswith("/"):
-            uri = uri[:-1]
+        if isinstance(uri, basestring):
+            uris = [uri]
+        else:
+            uris = list(uri)
+        uris = [u[:-1] if u.endswith("/") else u for u in uris]
 
-        self.uri = uri
+        self.uri = uris[0]
         
         self._uuids = deque()
 
         if not session:
             session = Session()
 
-        self._res = CouchdbResource(session, uri, timeout)
+        nodes = None
+        if len(uris) > 1:
+            nodes = NodeSet(uris, session, strategy)
+
+        self._res = CouchdbResource(session, self.uri, timeout, codec, release_body, retry, nodes,
+                                    observers=list(observers or []),
+                                    compress_threshold=compress_threshold,
+                                    single_flight=SingleFlight() if coalesce_reads else None)
+
+    def add_observer(self, observer):
+        """
+        Add an observer called before and after every request made by this server and
+        its databases. e.g. to collect latency histograms::
+
+            collector = LatencyCollector()
+            server.add_observer(collector)
+            ...
+            print collector.export_text()
+
+        :param observer: :class:`couchdbreq.instrument.Observer`
+        """
+        self._res.observers.append(observer)
 
     def get_info(self):
         """
@@ -44,7 +44,7 @@ def encode(v, charset="utf8"):
 def make_uri(segments, params=None, charset="utf-8", safe="/:", encode_keys=True):
     """
     Assemble a uri based on a base, any number of path segments, and query string parameters.
-    @params A list of 2-tuples or a dict
+    @params A list of 2-tuples, a dict or an already encoded query string
     """
     # build the path
     _path = []
@@ -70,7 +70,10 @@ def make_uri(segments, params=None, charset="utf-8", safe="/:", encode_keys=True
         count += 1
 
     if params is not None:
-        params_str = url_encode(params, charset, encode_keys)
+        if isinstance(params, str):
+            params_str = params
+        else:
+            params_str = url_encode(params, charset, encode_keys)
         if params_str:
             _path.extend(['?', params_str])
 
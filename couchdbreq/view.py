@@ -5,6 +5,97 @@
 #
 
 from .exceptions import MultipleResultsFound, NoResultFound
+from .jsonstream import JsonStreamParser
+from .utils import url_encode
+from .body import EncodedJson
+
+class ViewStream(object):
+    """
+    An iterator over the rows of a streamed view response.
+
+    Rows are parsed from the response one at a time as they arrive. The `total_rows`,
+    `offset` and `update_seq` attributes are None until the part of the response containing
+    them has been parsed. CouchDB sends `total_rows` and `offset` before the rows so they are
+    available once the first row has been read.
+
+    Do not construct directly. Use :meth:`couchdbreq.view.View.stream`.
+    """
+
+    def __init__(self, resp, schema, chunk_size):
+        self._resp = resp
+        self._schema = schema
+        self._parser = JsonStreamParser(resp.body_stream(chunk_size), 'rows', resp.codec.loads)
+
+    @property
+    def total_rows(self):
+        return self._parser.meta.get('total_rows')
+
+    @property
+    def offset(self):
+        return self._parser.meta.get('offset')
+
+    @property
+    def update_seq(self):
+        return self._parser.meta.get('update_seq')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, with_type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        schema = self._schema
+        try:
+            for row in self._parser:
+                if schema is not None:
+                    yield schema.wrap_row(row)
+                else:
+                    yield row
+        finally:
+            self.close()
+
+    def close(self):
+        """ Close the response. Called automatically once all rows have been read. """
+        self._resp.close()
+
+class Query(object):
+    """
+    A compiled view query. The parameters are encoded once into a query string and an
+    optional POST body, so executing the query again does no encoding.
+
+    Queries are immutable and hashable. Two queries are equal if they would send the same
+    request, so a query can be used as a cache key for its results.
+
+    Do not construct directly. Use :meth:`couchdbreq.view.View.get_query`.
+    """
+
+    __slots__ = ('db_uri', 'view_path', 'query_string', 'body', '_hash')
+
+    def __init__(self, db_uri, view_path, query_string, body):
+        object.__setattr__(self, 'db_uri', db_uri)
+        object.__setattr__(self, 'view_path', view_path)
+        object.__setattr__(self, 'query_string', query_string)
+        object.__setattr__(self, 'body', body) # Encoded keys or None for a GET
+        object.__setattr__(self, '_hash', hash((db_uri, view_path, query_string, body)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Query is immutable")
+
+    def _key(self):
+        return (self.db_uri, self.view_path, self.query_string, self.body)
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return '<Query %s?%s>' % (self.view_path, self.query_string)
 
 class View(object):
     """
@@ -27,27 +118,53 @@ class View(object):
         self._view_path = view_path
         self._schema = schema
 
-    def _iterator(self, **params):
-        
+        self._queries = {} # limit override -> Query
+
+    def get_query(self, limit=UNDEFINED_VALUE):
+        """
+        Get the compiled query of this view. The query is compiled once and reused.
+
+        :param limit: Override the limit of the view
+        :return: :class:`couchdbreq.view.Query`
+        """
+        query = self._queries.get(limit)
+        if query is None:
+            query = self._queries[limit] = self._compile(limit)
+        return query
+
+    def _compile(self, limit):
+        res = self._db._res
+
         mparams = {}
         for k, v in self._params.iteritems():
             if v == View.UNDEFINED_VALUE:
                 continue
             mparams[k] = v
-        for k, v in params.iteritems():
-            if v == View.UNDEFINED_VALUE:
-                continue
-            mparams[k] = v
-        
-        keys = None
-        if 'keys' in mparams:
-            keys = mparams.pop('keys')
-        
+        if limit != View.UNDEFINED_VALUE:
+            mparams['limit'] = limit
+
+        body = None
+        keys = mparams.pop('keys', None)
         if keys != None:
-            resp = self._db._res.post(self._view_path, payload={ 'keys': keys }, params=mparams)
-        else:
-            resp = self._db._res.get(self._view_path, params=mparams)
-        
+            body = EncodedJson(res.codec.dumps({ 'keys': keys }))
+
+        # Sorted so that equal parameters always compile to the same query string
+        params = sorted(res._encode_params(mparams).iteritems())
+        query_string = url_encode(params, res.charset, res.encode_keys)
+
+        return Query(res.uri, self._view_path, query_string, body)
+
+    def _request(self, stream=False, limit=UNDEFINED_VALUE):
+        query = self.get_query(limit)
+        res = self._db._res
+
+        if query.body is not None:
+            return res.post(query.view_path, payload=query.body, params=query.query_string,
+                            stream=stream)
+        return res.get(query.view_path, params=query.query_string, stream=stream)
+
+    def _iterator(self, limit=UNDEFINED_VALUE):
+        resp = self._request(limit=limit)
         schema = self._schema
         for row in resp.json_body['rows']:
             if schema is not None:
@@ -99,6 +216,40 @@ class View(object):
         """
         return list(self._iterator())
 
+    def stream(self, stream_chunk_size=16 * 1024):
+        """
+        Iterate over the rows without loading the whole response into memory.
+
+        The response is parsed incrementally so memory use does not grow with the number
+        of rows and the first row is available before the response has been fully received.
+        The response holds a connection until all rows have been read or the stream is closed,
+        so use the stream as a context manager if you might stop early::
+
+            with db.all_docs(include_docs=True).stream() as rows:
+                for row in rows:
+                    ...
+
+        :param stream_chunk_size: Size in bytes to read from the response at a time (default 16 * 1024)
+        :return: :class:`couchdbreq.view.ViewStream`
+        """
+        resp = self._request(stream=True)
+        return ViewStream(resp, self._schema, stream_chunk_size)
+
+    def raw(self, stream=False, stream_chunk_size=16 * 1024):
+        """
+        Get the undecoded json response of this query.
+
+        Use this to forward the response without decoding and encoding it again.
+
+        :param stream: boolean, if True return a file object
+        :param stream_chunk_size: Size in bytes to return per stream chunk (default 16 * 1024)
+        :return: Bytestring or file like iterable if stream=True
+        """
+        resp = self._request(stream=stream)
+        if stream:
+            return resp.body_stream(chunk_size=stream_chunk_size)
+        return resp.body_string()
+
     def count(self):
         """
         Return the number of results
@@ -3,8 +3,8 @@ import os
 import sys
 from imp import load_source
 
-if not hasattr(sys, 'version_info') or sys.version_info < (2, 6, 0, 'final'):
-    raise SystemExit("couchdbreq requires Python 2.6 or later.")
+if not hasattr(sys, 'version_info') or sys.version_info < (2, 7, 0, 'final'):
+    raise SystemExit("couchdbreq requires Python 2.7 or later.")
 
 from setuptools import setup, find_packages
 
@@ -32,7 +32,6 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: Apache Software License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Topic :: Database',
         'Topic :: Utilities',
@@ -43,6 +42,6 @@ setup(
     zip_safe = False,
 
     install_requires = [
-        'requests>=0.14.1',
+        'requests>=2.5.1',
     ]
 )
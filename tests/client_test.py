@@ -4,11 +4,28 @@
 # See the NOTICE for more information.
 #
 import unittest
+import threading
+import time
+import shutil
+import tempfile
+import json
 from os import path
+from StringIO import StringIO
+
+import requests
 
 from couchdbreq import Server, Session
+from couchdbreq.codec import JsonCodec
+from couchdbreq.retry import RetryPolicy
+from couchdbreq.balancer import RoundRobinStrategy, LeastOutstandingStrategy, EwmaStrategy
+from couchdbreq.instrument import LatencyCollector, get_operation, get_path_template
+from couchdbreq.cache import DocumentCache, ChangesCache
+from couchdbreq.bulk import _Batcher, _Pending
+from couchdbreq.concurrency import Future
+from couchdbreq.resource import CouchdbResource
 from couchdbreq.exceptions import DatabaseExistsException, ResourceNotFound, BulkSaveError, InvalidDatabaseNameError
 from couchdbreq.exceptions import CouchException, RequestError, RequestFailed, Timeout, InvalidAttachment, InvalidDocNameError
+from couchdbreq.exceptions import ResourceConflict, AttachmentDigestMismatch
 
 class ClientServerTestCase(unittest.TestCase):
     def setUp(self):
@@ -40,6 +57,111 @@ class ClientServerTestCase(unittest.TestCase):
         info = self.Server.get_info()
         self.assert_(info.has_key('version'))
     
+    def testCodec(self):
+        class CountingCodec(JsonCodec):
+            encoded = 0
+            decoded = 0
+            def dumps(self, obj):
+                self.encoded += 1
+                return JsonCodec.dumps(self, obj)
+            def loads(self, s):
+                self.decoded += 1
+                return JsonCodec.loads(self, s)
+
+        codec = CountingCodec()
+        server = Server(codec=codec)
+        db = server.create_db('couchdbkit_test')
+        db.save_doc({ '_id': 'test', 'number': 4 })
+        self.assertEqual(db.all_docs(key='test').one()['id'], 'test')
+        self.assert_(codec.encoded >= 2)
+        self.assert_(codec.decoded >= 2)
+
+    def testReleaseBody(self):
+        server = Server(release_body=True)
+        resp = server._res.get()
+        info = resp.json_body
+        self.assert_(info is resp.json_body)
+        self.assertEqual(resp.response, None)
+        self.assertRaises(ValueError, resp.body_string)
+
+    def testRetry(self):
+        server = Server(retry=RetryPolicy(max_attempts=3, backoff=0.01))
+        db = server.create_db('couchdbkit_test')
+        doc = { '_id': 'test', 'number': 4 }
+        db.save_doc(doc)
+        self.assertEqual(db.get_doc('test'), doc)
+
+        server = Server('http://127.0.0.1:1', retry=RetryPolicy(max_attempts=3, backoff=0.01))
+        self.assertRaises(RequestError, server.get_info)
+
+    def testRetryLostResponse(self):
+        class LosingSession(Session):
+            """ Sends a PUT but loses the response when lose_next_put is set """
+            lose_next_put = False
+
+            def request(self, method, url, **kwargs):
+                resp = Session.request(self, method, url, **kwargs)
+                if method == 'PUT' and self.lose_next_put:
+                    self.lose_next_put = False
+                    resp.close()
+                    raise requests.ConnectionError('The response was lost')
+                return resp
+
+        self.Server.create_db('couchdbkit_test')
+        session = LosingSession()
+        server = Server(session=session, retry=RetryPolicy(max_attempts=3, backoff=0.01))
+        db = server.get_db('couchdbkit_test')
+
+        # The first attempt was saved so the retry conflicts with it
+        doc = { '_id': 'test', 'number': 4,
+                '_attachments': { 'test.txt': { 'content_type': 'text/plain', 'data': 'Hello' } } }
+        session.lose_next_put = True
+        res = db.save_doc(doc)
+        self.assert_(res['rev'].startswith('1-'))
+        self.assertEqual(db.get_doc('test')['_rev'], res['rev'])
+
+        # A real conflict is still reported
+        session.lose_next_put = True
+        self.assertRaises(ResourceConflict, db.save_doc, { '_id': 'test', 'number': 5 })
+
+
+    def testMultipleNodes(self):
+        for strategy in (RoundRobinStrategy(), LeastOutstandingStrategy(), EwmaStrategy()):
+            server = Server(['http://127.0.0.1:5984', 'http://localhost:5984/'], strategy=strategy)
+            db = server.create_db('couchdbkit_test')
+            doc = { '_id': 'test', 'number': 4 }
+            db.save_doc(doc)
+            self.assertEqual(db.get_doc('test'), doc)
+            server.delete_db('couchdbkit_test')
+
+    def testPoolMetrics(self):
+        session = Session(pool_maxsize=2, pool_block=True, tcp_keepalive=True)
+        server = Server(session=session)
+        for _ in range(5):
+            server.get_info()
+        metrics = session.get_pool_metrics()
+        self.assertEqual(metrics['checkouts'], 5)
+        self.assertEqual(metrics['new_connections'], 1)
+        self.assertEqual(metrics['in_use'], 0)
+        self.assertEqual(metrics['reuse_ratio'], 0.8)
+
+    def testLatencyCollector(self):
+        collector = LatencyCollector()
+        server = Server(observers=[collector])
+        db = server.create_db('couchdbkit_test')
+        db.save_doc({ '_id': 'test', 'number': 4 })
+        db.get_doc('test')
+        db.all_docs().all()
+
+        stats = collector.get_stats()
+        self.assertEqual(stats['save_doc']['count'], 1)
+        self.assertEqual(stats['get_doc']['count'], 1)
+        self.assertEqual(stats['all_docs']['count'], 1)
+
+        text = collector.export_text()
+        self.assert_('couchdbreq_request_duration_seconds_count{operation="save_doc"} 1' in text)
+        self.assert_('couchdbreq_requests_total{operation="get_doc",method="GET",status="200"} 1' in text)
+
     def testCreateDb(self):
         
         self.assertRaises(ResourceNotFound, self.Server.get_db, 'couchdbkit_test')
@@ -230,6 +352,98 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assert_( "_design/a" in db)
         self.Server.delete_db('couchdbkit_test')
         
+    def testDocCache(self):
+        db = self.Server.create_db('couchdbkit_test')
+        doc = { '_id': 'test', 'number': 4 }
+        db.save_doc(doc)
+
+        cache = DocumentCache(max_entries=10)
+        db.set_doc_cache(cache)
+        self.assertEqual(db.get_doc('test'), doc)
+        doc1 = db.get_doc('test')
+        self.assertEqual(doc1, doc)
+        doc1['number'] = 5
+        db.save_doc(doc1)
+        self.assertEqual(db.get_doc('test')['number'], 5)
+        self.assertEqual(db.get_doc('test', rev=doc['_rev'])['number'], 4)
+        self.assertEqual(db.get_doc('test', rev=doc['_rev'])['number'], 4)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['revalidations'], 2)
+        self.Server.delete_db('couchdbkit_test')
+
+    def testChangesCache(self):
+        db = self.Server.create_db('couchdbkit_test')
+        doc = { '_id': 'test', 'number': 4 }
+        db.save_doc(doc)
+
+        cache = ChangesCache(db, poll_timeout=0.5)
+        try:
+            self.assertEqual(cache.get_doc('test'), doc)
+            self.assertEqual(cache.get_doc('test'), doc)
+            self.assertEqual(cache.get_stats()['hits'], 1)
+
+            doc['number'] = 5
+            db.save_doc(doc)
+            self.assert_(cache.wait_for_seq(db.get_info()['update_seq'], timeout=5))
+            self.assertEqual(cache.get_doc('test')['number'], 5)
+            self.assertRaises(ResourceNotFound, cache.get_doc, 'missing')
+        finally:
+            cache.close()
+
+        # Changes are no longer applied so the cache is not used
+        self.assertFalse(cache.is_following())
+        doc['number'] = 6
+        db.save_doc(doc)
+        self.assertEqual(cache.get_doc('test')['number'], 6)
+        self.Server.delete_db('couchdbkit_test')
+
+    def testGetDocs(self):
+        db = self.Server.create_db('couchdbkit_test')
+        for i in range(5):
+            db.save_doc({ '_id': 'test%d' % i, 'number': i })
+        db.delete_doc(db.get_doc('test4'))
+
+        docs = db.get_docs(['test3', 'missing', 'test0', 'test4', 'test1'], chunk_size=2)
+        self.assertEqual([doc and doc['number'] for doc in docs], [3, None, 0, None, 1])
+        self.assertEqual(docs.missing, ['missing'])
+        self.assertEqual(docs.deleted, ['test4'])
+        self.Server.delete_db('couchdbkit_test')
+
+    def testContainsMany(self):
+        db = self.Server.create_db('couchdbkit_test')
+        for i in range(5):
+            db.save_doc({ '_id': 'test%d' % i })
+        db.delete_doc(db.get_doc('test4'))
+
+        ids = ['test%d' % i for i in range(5)] + ['missing']
+        self.assertEqual(db.contains_many(ids, chunk_size=2), set(['test0', 'test1', 'test2', 'test3']))
+
+        revs = db.get_revs(ids, chunk_size=2)
+        self.assertEqual(sorted(revs), ['test0', 'test1', 'test2', 'test3'])
+        self.assertEqual(revs['test1'], db.get_rev('test1'))
+        self.Server.delete_db('couchdbkit_test')
+
+    def testReadCoalescer(self):
+        db = self.Server.create_db('couchdbkit_test')
+        for i in range(5):
+            db.save_doc({ '_id': 'test%d' % i, 'number': i })
+        db.save_doc({ '_id': '_local/test', 'number': 5 })
+        db.set_read_coalescer(db.bulk_reader(max_delay=0.01))
+
+        ids = ['test%d' % (i % 5) for i in range(20)] + ['missing']
+        docs = db.map_concurrent('get_doc', ids)
+        self.assertEqual([doc['number'] for doc in docs[:20]], [i % 5 for i in range(20)])
+        self.assert_(isinstance(docs[20], ResourceNotFound))
+        # _all_docs does not return local docs so they are read directly
+        self.assertEqual(db.get_doc('_local/test')['number'], 5)
+
+        db.get_read_coalescer().close()
+        db.set_read_coalescer(None)
+        self.Server.delete_db('couchdbkit_test')
+
     def testGetRev(self):
         db = self.Server.create_db('couchdbkit_test')
         doc = {}
@@ -308,6 +522,32 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assert_(len(attachment) == doc1['_attachments']['test.html']['length'])
         self.Server.delete_db('couchdbkit_test')
     
+    def testMultipartAttachments(self):
+        db = self.Server.create_db('couchdbkit_test')
+        text_attachment = "un texte attaché"
+        html_attachment = "<html><head><title>test attachment</title></head><body><p>Some words</p></body></html>"
+        doc = {
+            '_id': "docwithattachment",
+            "f": "value",
+            "_attachments": {
+                "test.txt": { "data": text_attachment },
+                "test.html": { "content_type": "text/html", "data": StringIO(html_attachment) }
+            }
+        }
+        db.save_doc(doc, multipart=True)
+        self.assert_(doc['_attachments']['test.html']['stub'])
+        self.assertEqual(db.fetch_attachment(doc, "test.txt"), text_attachment)
+        self.assertEqual(db.fetch_attachment(doc, "test.html"), html_attachment)
+
+        doc1 = db.get_doc("docwithattachment")
+        self.assertEqual(doc1['_attachments']['test.html']['content_type'], 'text/html')
+        self.assertEqual(doc1['_attachments']['test.txt']['length'], len(text_attachment))
+
+        doc['f'] = 'new value'
+        db.save_doc(doc)
+        self.assertEqual(db.fetch_attachment(doc, "test.html"), html_attachment)
+        self.Server.delete_db('couchdbkit_test')
+
     def testMultipleInlineAttachments(self):
         db = self.Server.create_db('couchdbkit_test')
         attachment = "<html><head><title>test attachment</title></head><body><p>Some words</p></body></html>"
@@ -388,6 +628,56 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assertRaises(InvalidAttachment, db.put_attachment, doc, {}, "test", "text/plain")
         self.Server.delete_db('couchdbkit_test')
         
+    def testPutAttachmentFile(self):
+        db = self.Server.create_db('couchdbkit_test')
+        doc = { '_id': 'test' }
+        db.save_doc(doc)
+
+        progress = []
+        filename = path.join(path.dirname(__file__), 'data', 'text_attachment.txt')
+        db.put_attachment_file(doc, filename, chunk_size=4,
+                               callback=lambda sent, length: progress.append((sent, length)))
+        self.assertEqual(db.fetch_attachment(doc, 'text_attachment.txt'), "Some unicode: î\n")
+        self.assertEqual(doc['_attachments']['text_attachment.txt']['content_type'], 'text/plain')
+        self.assertEqual(progress[-1], (len("Some unicode: î\n"), len("Some unicode: î\n")))
+        self.assertEqual(len(progress), 5)
+
+        with open(filename, 'rb') as f:
+            f.seek(5)
+            db.put_attachment_file(doc, f, 'tail', 'text/plain')
+        self.assertEqual(db.fetch_attachment(doc, 'tail'), "unicode: î\n")
+        self.Server.delete_db('couchdbkit_test')
+
+    def testAttachmentsWithoutRefresh(self):
+        db = self.Server.create_db('couchdbkit_test')
+        doc = { '_id': 'test' }
+        db.save_doc(doc)
+
+        def assertStubsMatch():
+            saved = db.get_doc('test')
+            self.assertEqual(doc['_rev'], saved['_rev'])
+            self.assertEqual(sorted(doc['_attachments']), sorted(saved['_attachments']))
+            for name, stub in doc['_attachments'].items():
+                self.assert_('digest' not in stub)
+                self.assertEqual(stub, dict((k, saved['_attachments'][name][k]) for k in stub))
+
+        db.put_attachment(doc, "\x00\x01", "test.bin", "application/octet-stream", refresh=False)
+        db.put_attachment(doc, StringIO("\x02\x03\x04"), "other.bin", "application/octet-stream",
+                          refresh=False)
+        assertStubsMatch()
+
+        text = "a text attachment which CouchDB compresses " * 10
+        db.put_attachment(doc, text, "test.txt", "text/plain", refresh=False)
+        assertStubsMatch()
+        self.assertEqual(db.fetch_attachment(doc, "test.txt"), text)
+
+        db.delete_attachment(doc, "test.bin", refresh=False)
+        assertStubsMatch()
+        db.delete_attachment(doc, "other.bin", refresh=False)
+        db.delete_attachment(doc, "test.txt", refresh=False)
+        self.assertEqual(doc, db.get_doc('test'))
+        self.Server.delete_db('couchdbkit_test')
+
     def testFetchAttachmentStream(self):
         db = self.Server.create_db('couchdbkit_test')
         doc = { 'string': 'test', 'number': 4 }
@@ -399,6 +689,95 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assertEqual(text_attachment, fetch_attachment)
         self.Server.delete_db('couchdbkit_test')
    
+    def testFetchAttachmentStreamReadinto(self):
+        db = self.Server.create_db('couchdbkit_test')
+        doc = {}
+        db.save_doc(doc)
+        db.put_attachment(doc, "line 1\nline 2\n" + "x" * 5000, "test", "text/plain")
+
+        stream = db.fetch_attachment(doc, "test", stream=True, stream_chunk_size=3)
+        self.assertEqual(stream.readline(), "line 1\n")
+        b = bytearray(4)
+        self.assertEqual(stream.readinto(b), 4)
+        self.assertEqual(str(b), "line")
+        self.assertEqual(stream.readline(), " 2\n")
+
+        out = StringIO()
+        with stream:
+            shutil.copyfileobj(stream, out)
+        self.assertEqual(out.getvalue(), "x" * 5000)
+        self.Server.delete_db('couchdbkit_test')
+
+    def testFetchAttachmentRange(self):
+        db = self.Server.create_db('couchdbkit_test')
+        doc = { '_id': 'test' }
+        db.save_doc(doc)
+        data = ''.join(chr(i % 256) for i in range(100000))
+        db.put_attachment(doc, data, "test.bin", "application/octet-stream")
+
+        self.assertEqual(db.fetch_attachment(doc, "test.bin", offset=10, length=20), data[10:30])
+        self.assertEqual(db.fetch_attachment(doc, "test.bin", offset=99990), data[99990:])
+        stream = db.fetch_attachment(doc, "test.bin", stream=True, offset=500, length=1000)
+        self.assertEqual(stream.read(), data[500:1500])
+        self.assertEqual(db.fetch_attachment(doc, "test.bin", offset=10, length=0), '')
+        self.assertRaises(ValueError, db.fetch_attachment, doc, "test.bin", offset=-1)
+        self.assertRaises(ValueError, db.fetch_attachment, doc, "test.bin", length=-1)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = path.join(tmpdir, 'test.bin')
+            with open(filename, 'wb') as f:
+                f.write(data[:30000]) # A download which stopped part way
+            stub = db.download_attachment(doc, "test.bin", filename)
+            self.assertEqual(stub['length'], len(data))
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+            with open(filename, 'r+b') as f:
+                f.write('corrupt')
+                f.truncate(30000)
+            self.assertRaises(AttachmentDigestMismatch, db.download_attachment, 'test', "test.bin", filename)
+
+            # A file error is not retried
+            self.assertRaises(IOError, db.download_attachment, 'test', "test.bin",
+                              path.join(tmpdir, 'missing', 'test.bin'))
+
+            # A stub without a length is fetched
+            db.put_attachment(doc, data[:100], "other.bin", "application/octet-stream", refresh=False)
+            del doc['_attachments']['other.bin']['length']
+            filename = path.join(tmpdir, 'other.bin')
+            stub = db.download_attachment(doc, "other.bin", filename, verify=False)
+            self.assertEqual(stub['length'], 100)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.Server.delete_db('couchdbkit_test')
+
+    def testDownloadCompressedAttachment(self):
+        db = self.Server.create_db('couchdbkit_test')
+        doc = { '_id': 'test' }
+        db.save_doc(doc)
+        data = ''.join('line %d of a text attachment\n' % i for i in range(5000))
+        db.put_attachment(doc, data, "test.txt", "text/plain")
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = path.join(tmpdir, 'test.txt')
+            stub = db.download_attachment('test', "test.txt", filename)
+            # The digest is of the compressed data so only the length is checked
+            self.assertEqual(stub['encoding'], 'gzip')
+            self.assertEqual(stub['length'], len(data))
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+            with open(filename, 'r+b') as f:
+                f.truncate(30000) # A download which stopped part way
+            db.download_attachment(doc, "test.txt", filename)
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), data)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.Server.delete_db('couchdbkit_test')
+
     def testEmptyAttachment(self):
         db = self.Server.create_db('couchdbkit_test')
         doc = {}
@@ -482,6 +861,102 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assert_(doc['number'] == 42) 
         self.Server.delete_db('couchdbkit_test')
    
+    def testSaveDocsGenerator(self):
+        db = self.Server.create_db('couchdbkit_test')
+        docs = ({ 'number': i } for i in range(1000))
+        results = db.save_docs(docs, stream_chunk_size=1024)
+        self.assertEqual(len(results), 1000)
+        self.assertEqual(db.length(), 1000)
+        self.assertEqual(db.get_doc(results[500]['id'])['number'], 500)
+
+        # No request is made while the docs are sent so one connection is enough
+        server = Server(session=Session(pool_maxsize=1, pool_block=True))
+        docs = ({ 'number': i } for i in range(100))
+        results = server.get_db('couchdbkit_test').save_docs(docs, update_docs=False)
+        self.assertEqual(len(results), 100)
+        self.assertEqual(db.length(), 1100)
+        self.Server.delete_db('couchdbkit_test')
+
+    def testBulkWriter(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_doc({ '_id': 'conflict' })
+
+        with db.bulk_writer(max_docs=10) as writer:
+            futures = [writer.save({ 'number': i }) for i in range(25)]
+            conflict = writer.save({ '_id': 'conflict' })
+            self.assert_(writer.flush())
+
+        self.assert_(all(future.result().startswith('1-') for future in futures))
+        self.assertRaises(ResourceConflict, conflict.result)
+        self.assertEqual(db.length(), 26)
+
+        # A closed writer does not block
+        self.assertRaises(ValueError, writer.save, { 'number': 25 })
+        self.assertRaises(ValueError, writer.flush)
+        self.Server.delete_db('couchdbkit_test')
+
+    def testWriteCoalescer(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.set_write_coalescer(db.bulk_writer(max_delay=0.01))
+
+        docs = [{ 'number': i } for i in range(20)]
+        results = db.map_concurrent('save_doc', docs)
+        self.assert_(all(result['rev'] == doc['_rev'] for result, doc in zip(results, docs)))
+
+        docs[0]['number'] = 42
+        db.save_doc(docs[0])
+        self.assert_(docs[0]['_rev'].startswith('2-'))
+        self.assertRaises(ResourceConflict, db.save_doc, { '_id': docs[1]['_id'] })
+
+        db.get_write_coalescer().close()
+        db.set_write_coalescer(None)
+        self.assertEqual(db.get_doc(docs[0]['_id'])['number'], 42)
+        self.Server.delete_db('couchdbkit_test')
+
+    def testCompressedSaveMultipleDocs(self):
+        server = Server(compress_threshold=1024)
+        db = server.create_db('couchdbkit_test')
+        docs = [{ 'string': 'test %d' % i, 'number': i } for i in range(100)]
+        db.save_docs(docs)
+        self.assertEqual(db.length(), 100)
+        self.assertEqual(db.get_doc(docs[50]['_id'])['number'], 50)
+        server.delete_db('couchdbkit_test')
+
+    def testCompressedAttachmentNotCompressed(self):
+        server = Server(compress_threshold=10)
+        db = server.create_db('couchdbkit_test')
+        doc = { '_id': 'test' }
+        db.save_doc(doc)
+        data = '{"a": "%s"}' % ('x' * 1000)
+        db.put_attachment(doc, data, 'test.json', 'application/json', content_length=len(data))
+        self.assertEqual(db.fetch_attachment(doc, 'test.json'), data)
+        self.assertEqual(doc['_attachments']['test.json']['length'], len(data))
+        server.delete_db('couchdbkit_test')
+
+    def testMapConcurrent(self):
+        db = self.Server.create_db('couchdbkit_test')
+        docs = [{ '_id': 'test%d' % i, 'number': i } for i in range(20)]
+        db.save_docs(docs)
+
+        progress = []
+        results = db.map_concurrent('get_doc', ['test%d' % i for i in range(20)] + ['missing'],
+            max_workers=4, callback=lambda i, item, result, error: progress.append(i))
+        self.assertEqual(results[:20], docs)
+        self.assert_(isinstance(results[20], ResourceNotFound))
+        self.assertEqual(sorted(progress), range(21))
+        self.Server.delete_db('couchdbkit_test')
+
+    def testCoalesceReads(self):
+        server = Server(coalesce_reads=True)
+        db = server.create_db('couchdbkit_test')
+        db.save_doc({ '_id': 'test', 'number': 4 })
+
+        results = db.map_concurrent('get_doc', ['test'] * 20 + ['missing'])
+        self.assertEqual([doc['number'] for doc in results[:20]], [4] * 20)
+        self.assertEqual(len(set(id(doc) for doc in results[:20])), 20)
+        self.assert_(isinstance(results[20], ResourceNotFound))
+        server.delete_db('couchdbkit_test')
+
     def testDeleteMultipleDocs(self):
         db = self.Server.create_db('couchdbkit_test')
         docs = [
@@ -655,6 +1130,56 @@ class ClientViewTestCase(unittest.TestCase):
 
         self.Server.delete_db('couchdbkit_test')
 
+    def testViewQuery(self):
+        db = self.Server.create_db('couchdbkit_test')
+        for i in range(3):
+            db.save_doc({ '_id': 'test%d' % i })
+
+        view = db.all_docs(startkey='test1')
+        query = view.get_query()
+        self.assert_(query is view.get_query())
+        self.assertEqual(query, db.all_docs(startkey='test1').get_query())
+        self.assertEqual(hash(query), hash(db.all_docs(startkey='test1').get_query()))
+        self.assertNotEqual(query, view.filter(limit=1).get_query())
+
+        self.assertEqual(len(view.all()), 2)
+        self.assertEqual(view.first()['id'], 'test1')
+        self.assertEqual(db.all_docs(keys=['test0', 'test2']).count(), 2)
+
+        self.Server.delete_db('couchdbkit_test')
+
+    def testViewStream(self):
+        db = self.Server.create_db('couchdbkit_test')
+        for i in range(10):
+            db.save_doc({ '_id': 'test%d' % i, 'number': i })
+
+        rows = db.all_docs(include_docs=True).stream(stream_chunk_size=7)
+        self.assertEqual(rows.total_rows, None)
+        ids = [row['id'] for row in rows]
+        self.assertEqual(ids, [row['id'] for row in db.all_docs().all()])
+        self.assertEqual(rows.total_rows, 10)
+        self.assertEqual(rows.offset, 0)
+
+        with db.all_docs(limit=2).stream() as rows:
+            self.assertEqual(iter(rows).next()['id'], 'test0')
+
+        self.Server.delete_db('couchdbkit_test')
+
+    def testViewRaw(self):
+        db = self.Server.create_db('couchdbkit_test')
+        doc = { '_id': 'test', 'number': 4 }
+        db.save_doc(doc)
+
+        self.assertEqual(json.loads(db.get_doc('test', raw=True)), doc)
+
+        raw = db.all_docs().raw()
+        self.assertEqual(json.loads(raw)['rows'], db.all_docs().all())
+
+        stream = db.all_docs().raw(stream=True)
+        self.assertEqual(json.loads(stream.read())['rows'], db.all_docs().all())
+
+        self.Server.delete_db('couchdbkit_test')
+
     def testCount(self):
         db = self.Server.create_db('couchdbkit_test')
         # save 2 docs 
@@ -858,6 +1383,107 @@ class ClientViewTestCase(unittest.TestCase):
         self.assertEqual(s[-1], 'B')
         self.assertEqual(len(s), 2933)
         
+class InstrumentTestCase(unittest.TestCase):
+
+    def testGetOperation(self):
+        def operation(method, path):
+            return get_operation(method, get_path_template(path))
+
+        self.assertEqual(operation('GET', ''), 'server')
+        self.assertEqual(operation('GET', '_uuids?count=10'), 'uuids')
+        self.assertEqual(operation('POST', '_session'), 'session')
+        self.assertEqual(operation('PUT', 'db'), 'database')
+        self.assertEqual(operation('PUT', 'db/doc'), 'save_doc')
+        self.assertEqual(operation('GET', 'db/_design/app/_view/all'), 'view')
+        # System databases are databases
+        self.assertEqual(operation('GET', '_users'), 'database')
+        self.assertEqual(operation('GET', '_users/org.couchdb.user:bob'), 'get_doc')
+        self.assertEqual(operation('POST', '_replicator/_bulk_docs'), 'bulk_docs')
+
+class BatcherTestCase(unittest.TestCase):
+
+    def testCloseWhileProducerBlocked(self):
+        release = threading.Event()
+        class Batcher(_Batcher):
+            def _process(self, batch):
+                release.wait()
+                for pending in batch:
+                    pending.future.set_result(pending.doc)
+
+        batcher = Batcher('test', 1, float('inf'), 0, 1)
+        futures = [Future() for _ in range(3)]
+        batcher._put(_Pending(0, None, 0, futures[0]))
+        while not batcher._queue.empty(): # Wait until it is being processed
+            time.sleep(0.01)
+        batcher._put(_Pending(1, None, 0, futures[1])) # The queue is full
+
+        errors = []
+        def produce():
+            try:
+                batcher._put(_Pending(2, None, 0, futures[2]))
+            except ValueError as e:
+                errors.append(e)
+        producer = threading.Thread(target=produce)
+        producer.start()
+        time.sleep(0.1)
+
+        closer = threading.Thread(target=batcher.close)
+        closer.start()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(len(errors), 1)
+
+        release.set()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        self.assertEqual([future.result() for future in futures[:2]], [0, 1])
+        self.assertRaises(ValueError, batcher.flush)
+
+class RetryTestCase(unittest.TestCase):
+
+    def testGetDelay(self):
+        retry = RetryPolicy(backoff=0.1, max_backoff=0.5, jitter=False)
+        self.assertEqual([retry.get_delay(n) for n in range(1, 6)], [0.1, 0.2, 0.4, 0.5, 0.5])
+
+        retry = RetryPolicy(backoff=0.1, max_backoff=0.5)
+        for n in range(1, 6):
+            for _ in range(100):
+                self.assert_(0 <= retry.get_delay(n) <= min(0.5, 0.1 * 2 ** (n - 1)))
+
+    def testDeadline(self):
+        retry = RetryPolicy(max_attempts=100, backoff=0.05, jitter=False, deadline=0.3)
+        server = Server('http://127.0.0.1:1', retry=retry)
+        start = time.time()
+        self.assertRaises(RequestError, server.get_info)
+        self.assert_(time.time() - start < 1)
+
+class ResourceTestCase(unittest.TestCase):
+    """ prepare() and make_response() do not need a session """
+
+    def setUp(self):
+        self.res = CouchdbResource(None, 'http://127.0.0.1:5984/couchdbkit_test', 5)
+
+    def testPrepare(self):
+        uri, payload, headers = self.res.prepare('doc', payload={'a': 1}, params={'rev': '1-a'})
+        self.assertEqual(uri, 'http://127.0.0.1:5984/couchdbkit_test/doc?rev=1-a')
+        self.assertEqual(json.loads(payload), {'a': 1})
+        self.assertEqual(headers['Content-Type'], 'application/json')
+
+        res = CouchdbResource(None, 'http://127.0.0.1:5984/couchdbkit_test', 5, compress_threshold=0)
+        uri, payload, headers = res.prepare('doc', payload={'a': 1})
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertFalse(isinstance(payload, basestring))
+
+    def testMakeResponse(self):
+        resp = self.res.make_response(200, {'Content-Type': 'application/json'}, '{"ok": true}')
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers['content-type'], 'application/json')
+        self.assertEqual(resp.json_body, {'ok': True})
+        self.assertEqual(resp.body_stream(4).read(), '{"ok": true}')
+
+        self.assertRaises(ResourceNotFound, self.res.make_response, 404, {},
+                          '{"error": "not_found", "reason": "missing"}')
+
 if __name__ == '__main__':
     unittest.main()
 